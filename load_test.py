@@ -0,0 +1,318 @@
+"""Concurrent-session load test for the AI Template Mapper app
+
+Drives N headless sessions of packaging.py through Streamlit's testing API
+(login, template upload, data upload, mapping and batch download) using
+synthetic files, then reports latency percentiles per page action and the
+peak memory of the process hosting all sessions.
+
+    python load_test.py --sessions 8 --rows 50 --iterations 2 --json report.json
+"""
+import os
+import sys
+
+# Run as a script, this directory comes first on sys.path and the app file
+# (packaging.py) would shadow the 'packaging' library Streamlit imports
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path = [path for path in sys.path if os.path.abspath(path or os.curdir) != HERE]
+
+import argparse
+import io
+import json
+import logging
+import resource
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import openpyxl
+from streamlit.runtime.runtime import Runtime
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+APP_PATH = os.path.join(HERE, 'packaging.py')
+ACTIONS = ('login', 'navigate', 'upload_template', 'upload_data', 'mapping', 'batch_download')
+PERCENTILES = (50, 90, 95, 99)
+
+# AppTest compiles the script into a fresh ScriptCache on every run; a server
+# shares one cache across sessions. Share one here too, which also keeps
+# sessions from compiling concurrently (not thread-safe on Python 3.11)
+_shared_script_cache = ScriptCache()
+_get_bytecode = ScriptCache.get_bytecode
+ScriptCache.get_bytecode = lambda self, script_path: _get_bytecode(_shared_script_cache, script_path)
+
+# AppTest also installs a mock Runtime singleton per run and clears it when the
+# run ends, pulling it from under sessions still running. Keep the first one for
+# every session, as a server runs all sessions on one Runtime
+_shared_runtime = []
+_runtime_instance = Runtime.instance
+
+def _shared_runtime_instance(cls):
+    if not _shared_runtime:
+        _shared_runtime.append(_runtime_instance())
+    return _shared_runtime[0]
+
+Runtime.instance = classmethod(_shared_runtime_instance)
+Runtime.exists = classmethod(lambda cls: bool(_shared_runtime) or cls._instance is not None)
+
+def make_template(extra_fields=0):
+    """Packaging instruction form with header labels, two section tables and optional extra labels"""
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet['A1'] = 'PACKAGING INSTRUCTION SHEET FOR SUPPLIER'
+    worksheet['A3'] = 'Vendor Name'
+    worksheet['A4'] = 'Part No'
+    worksheet['A5'] = 'Description'
+    worksheet['F3'] = 'Revision No'
+    worksheet['A7'] = 'Primary Packaging Instruction'
+    worksheet.merge_cells('A7:D7')
+    worksheet['A8'], worksheet['B8'], worksheet['C8'] = 'L-mm', 'W-mm', 'H-mm'
+    worksheet['A11'] = 'Secondary Packaging Instruction'
+    worksheet.merge_cells('A11:D11')
+    worksheet['A12'], worksheet['B12'], worksheet['C12'] = 'L-mm', 'W-mm', 'H-mm'
+    for index in range(extra_fields):
+        worksheet.cell(row=15 + index, column=1, value=f"Remark {index + 1}")
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+def make_data(rows, extra_fields=0):
+    """CSV whose columns match the synthetic template, with some repeated rows"""
+    header = ['Vendor Name', 'Part No', 'Description', 'Revision', 'Primary L-mm', 'Primary W-mm',
+              'Primary H-mm', 'Secondary L-mm', 'Secondary W-mm', 'Secondary H-mm']
+    header += [f"Remark {index + 1}" for index in range(extra_fields)]
+    lines = [','.join(header)]
+    for row in range(rows):
+        values = [f"Vendor {row % 7}", f"P-{row:05d}", 'Molded housing', f"R{row % 3}",
+                  str(100 + row % 50), '80', '40', '600', '400', '300']
+        values += [f"note {row % 5}" for _ in range(extra_fields)]
+        lines.append(','.join(values))
+    return '\n'.join(lines).encode()
+
+class LatencyRecorder:
+    """Thread-safe collection of action latencies and failures"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {action: [] for action in ACTIONS}
+        self.failures = {action: [] for action in ACTIONS}
+
+    def record(self, action, seconds, error=None):
+        with self.lock:
+            self.latencies[action].append(seconds)
+            if error:
+                self.failures[action].append(error)
+
+    def summary(self):
+        rows = []
+        with self.lock:
+            for action in ACTIONS:
+                samples = np.array(self.latencies[action]) * 1000
+                row = {'action': action, 'count': len(samples), 'failures': len(self.failures[action])}
+                for percentile in PERCENTILES:
+                    row[f"p{percentile}_ms"] = None
+                row['max_ms'] = None
+                if len(samples):
+                    for percentile in PERCENTILES:
+                        row[f"p{percentile}_ms"] = round(float(np.percentile(samples, percentile)), 1)
+                    row['max_ms'] = round(float(samples.max()), 1)
+                rows.append(row)
+        return rows
+
+    def failure_examples(self, limit=3):
+        with self.lock:
+            return {action: errors[:limit] for action, errors in self.failures.items() if errors}
+
+class MemorySampler(threading.Thread):
+    """Samples the process RSS in the background and keeps the peak"""
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_bytes = 0
+        self.baseline_bytes = self.rss()
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def rss():
+        if PSUTIL_AVAILABLE:
+            return psutil.Process().memory_info().rss
+        return 0
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak_bytes = max(self.peak_bytes, self.rss())
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        # ru_maxrss (kilobytes on Linux) also catches spikes between samples
+        self.peak_bytes = max(self.peak_bytes, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+        return self.peak_bytes
+
+class SessionFailed(Exception):
+    pass
+
+class SimulatedSession:
+    """One user session walking the app from login to batch download"""
+    def __init__(self, session_id, args, recorder, template_bytes, data_bytes):
+        self.session_id = session_id
+        self.args = args
+        self.recorder = recorder
+        self.template_bytes = template_bytes
+        self.data_bytes = data_bytes
+        self.template_name = f"Load Test {session_id}"
+        self.app = None
+
+    def find(self, elements, label):
+        for element in elements:
+            if label in element.label:
+                return element
+        raise SessionFailed(f"No widget labelled '{label}'")
+
+    def step(self, action, interact, check=None):
+        """Apply a widget interaction, time the rerun it triggers and check the page"""
+        started = time.perf_counter()
+        try:
+            interact(self.app)
+            started = time.perf_counter()
+            self.app.run(timeout=self.args.timeout)
+        except Exception as e:
+            error = str(e) if isinstance(e, SessionFailed) else f"{type(e).__name__}: {e}"
+            self.recorder.record(action, time.perf_counter() - started, error)
+            raise SessionFailed(f"{action}: {error}")
+        elapsed = time.perf_counter() - started
+
+        error = None
+        if self.app.exception:
+            error = self.app.exception[0].message
+        elif self.app.error:
+            error = self.app.error[0].value
+        elif check is not None and not check(self.app):
+            error = f"Unexpected page after {action}"
+        self.recorder.record(action, elapsed, error)
+        if error:
+            raise SessionFailed(f"{action}: {error}")
+
+    def navigate(self, page):
+        self.step('navigate', lambda app: self.find(app.selectbox, 'Select Page').select(page))
+
+    def has_success(self, text):
+        return lambda app: any(text in element.value for element in app.success)
+
+    def run(self):
+        self.app = AppTest.from_file(APP_PATH, default_timeout=self.args.timeout)
+        self.app.run()
+
+        def login(app):
+            self.find(app.text_input, 'Username').input(self.args.username)
+            self.find(app.text_input, 'Password').input(self.args.password)
+            self.find(app.button, 'Login').click()
+        self.step('login', login, lambda app: any(page.label == 'Select Page' for page in app.selectbox))
+
+        self.navigate('Upload Template')
+
+        def upload_template(app):
+            self.find(app.text_input, 'Template Name').input(self.template_name)
+            app.file_uploader[0].set_value((f"{self.session_id}.xlsx", self.template_bytes,
+                                            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'))
+            self.find(app.button, 'Upload').click()
+        self.step('upload_template', upload_template, self.has_success('uploaded successfully'))
+
+        self.navigate('AI Data Processor')
+        self.step('upload_data',
+                  lambda app: app.file_uploader[0].set_value((f"{self.session_id}.csv", self.data_bytes, 'text/csv')),
+                  lambda app: any('Process with AI' in button.label for button in app.button))
+
+        for _ in range(self.args.iterations):
+            self.step('mapping', lambda app: self.find(app.button, 'Process with AI').click(),
+                      self.has_success('Processing complete'))
+            self.step('batch_download', lambda app: self.find(app.button, 'Process All Rows').click(),
+                      lambda app: any('Download All Filled' in button.label
+                                      for button in app.get('download_button')))
+
+def run_load_test(args):
+    """Run all sessions and return the report dict"""
+    template_bytes = make_template(args.extra_fields)
+    data_bytes = make_data(args.rows, args.extra_fields)
+    recorder = LatencyRecorder()
+    sessions_failed = []
+
+    # Keep the shared mapping memory out of the working tree
+    memory_dir = tempfile.mkdtemp(prefix='load_test_')
+    os.environ['MAPPING_MEMORY_PATH'] = os.path.join(memory_dir, 'mapping_memory.json')
+
+    def run_session(session_id):
+        time.sleep(args.ramp_up * session_id / max(args.sessions, 1))
+        try:
+            SimulatedSession(session_id, args, recorder, template_bytes, data_bytes).run()
+        except Exception as e:
+            sessions_failed.append(f"session {session_id}: {e}")
+
+    sampler = MemorySampler()
+    sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        list(executor.map(run_session, range(args.sessions)))
+    wall_seconds = time.perf_counter() - started
+    peak_bytes = sampler.stop()
+
+    return {
+        'sessions': args.sessions,
+        'iterations': args.iterations,
+        'rows': args.rows,
+        'wall_seconds': round(wall_seconds, 2),
+        'sessions_failed': len(sessions_failed),
+        'baseline_rss_mb': round(sampler.baseline_bytes / 1024 / 1024, 1),
+        'peak_rss_mb': round(peak_bytes / 1024 / 1024, 1),
+        'actions': recorder.summary(),
+        'failure_examples': recorder.failure_examples(),
+        'session_errors': sessions_failed[:10]
+    }
+
+def print_report(report):
+    print(f"\n{report['sessions']} sessions x {report['iterations']} iteration(s), {report['rows']} data rows, "
+          f"{report['wall_seconds']}s wall time, {report['sessions_failed']} session(s) failed")
+    print(f"Process memory: baseline {report['baseline_rss_mb']} MB, peak {report['peak_rss_mb']} MB\n")
+    columns = ['action', 'count', 'failures'] + [f"p{p}_ms" for p in PERCENTILES] + ['max_ms']
+    print(''.join(f"{column:>16}" for column in columns))
+    for row in report['actions']:
+        print(''.join(f"{'-' if row[column] is None else row[column]:>16}" for column in columns))
+    for error in report['session_errors']:
+        print(f"  ! {error}")
+    for action, errors in report['failure_examples'].items():
+        print(f"\n{action} failures:")
+        for error in errors:
+            print(f"  - {error}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the AI Template Mapper app")
+    parser.add_argument('--sessions', type=int, default=4, help="Concurrent sessions")
+    parser.add_argument('--iterations', type=int, default=1, help="Mapping + batch runs per session")
+    parser.add_argument('--rows', type=int, default=20, help="Rows in the synthetic data file")
+    parser.add_argument('--extra-fields', type=int, default=0, help="Additional labels/columns in the synthetic files")
+    parser.add_argument('--ramp-up', type=float, default=0.0, help="Seconds over which session starts are spread")
+    parser.add_argument('--timeout', type=float, default=300.0, help="Seconds allowed per rerun")
+    parser.add_argument('--username', default='admin',
+                        help="Account used by every session (template upload needs admin)")
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--json', help="Also write the report to this file")
+    args = parser.parse_args()
+
+    # Per-rerun Streamlit warnings (missing ScriptRunContext, deprecations) drown the report
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+
+    report = run_load_test(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+if __name__ == '__main__':
+    main()
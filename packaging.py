@@ -4,16 +4,26 @@ import numpy as np
 import os
 import json
 import hashlib
+import html
 import nltk
 from datetime import datetime
 from difflib import SequenceMatcher
 import openpyxl
 from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
-from openpyxl.utils import get_column_letter
+from openpyxl.utils import get_column_letter, range_boundaries
 import re
 import io
 import tempfile
 import shutil
+import pickle
+import weakref
+import struct
+import sys
+from array import array
+import threading
+import time
+from contextlib import contextmanager
+from collections import OrderedDict, deque
 from pathlib import Path
 
 # Configure Streamlit page
@@ -30,8 +40,10 @@ try:
     from nltk.corpus import stopwords
     from sklearn.feature_extraction.text import TfidfVectorizer
     from sklearn.metrics.pairwise import cosine_similarity
+    from sklearn.base import clone
     
-    # Initialize NLTK with better error handling
+    # Initialize NLTK with better error handling (once per process, not on every rerun)
+    @st.cache_resource(show_spinner=False)
     def initialize_nltk():
         """Initialize NLTK with proper downloads and fallbacks"""
         try:
@@ -74,15 +86,513 @@ except ImportError as e:
     NLTK_READY = False
     st.warning("⚠️ Advanced NLP features disabled. Install nltk and scikit-learn for better matching.")
 
-class AdvancedTemplateMapper:
+# Optional Arrow support for Parquet / Arrow IPC (Feather) data files
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+    import pyarrow.ipc as ipc
+    ARROW_AVAILABLE = True
+except ImportError:
+    ARROW_AVAILABLE = False
+
+# Optional process resource monitoring
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+class SharedLRUCache:
+    """Bounded LRU cache that is safe to use from concurrent session threads"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return None
+    
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+    
+    def __len__(self):
+        return len(self._items)
+    
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+class SharedNLPResources:
+    """Expensive, immutable NLP state shared by every session in the process"""
+    CACHE_SIZE = 100000
+    
     def __init__(self):
-        self.similarity_threshold = 0.3
-        self.stop_words = {
+        self.stop_words = frozenset({
             'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from',
             'has', 'he', 'in', 'is', 'it', 'its', 'of', 'on', 'that', 'the',
             'to', 'was', 'will', 'with', 'or', 'but', 'not', 'this', 'have',
             'had', 'what', 'when', 'where', 'who', 'which', 'why', 'how'
-        }
+        })
+        # Template vectorizer; each similarity call fits a clone so sessions never share fitted state
+        self.vectorizer = None
+        if ADVANCED_NLP:
+            try:
+                self.stop_words = frozenset(stopwords.words('english'))
+                self.vectorizer = TfidfVectorizer(stop_words='english', ngram_range=(1, 2))
+            except Exception as e:
+                print(f"Warning: Could not load NLTK stopwords: {e}")
+        
+        # Compiled cell classifier patterns
+        self.data_patterns = [re.compile(pattern) for pattern in [
+            r'^_+$', r'^\.*$', r'^-+$', r'^\[.*\]$', r'^\{.*\}$', r'^<.*>$',
+            r'enter|fill|data|value|input|here|placeholder', r'^\d{1,2}/\d{1,2}/\d{2,4}$',
+            r'^dd/mm/yyyy|mm/dd/yyyy|yyyy-mm-dd$', r'^\$\d*\.?\d*$', r'^\d*\.?\d*$',
+        ]]
+        self.table_unit_pattern = re.compile(r'mm|cm|kg|gm|pcs|qty|pack|dimension|weight|size')
+        
+        # Threshold-independent results keyed by preprocessed text
+        self.similarity_cache = SharedLRUCache(self.CACHE_SIZE)
+        self.classification_cache = SharedLRUCache(self.CACHE_SIZE)
+        
+        # Template analyses keyed by structural fingerprint
+        self.template_cache = SharedLRUCache(256)
+        
+        # Column token indexes keyed by data header
+        self.column_index_cache = SharedLRUCache(64)
+
+@st.cache_resource(show_spinner=False)
+def get_shared_resources():
+    """Process-wide SharedNLPResources, created once and reused by all sessions"""
+    return SharedNLPResources()
+
+class MappingDiagnostics:
+    """Collects errors and warnings from the mapping engine for one summary after a run"""
+    MAX_LOCATIONS = 10
+    
+    def __init__(self):
+        self.entries = OrderedDict()  # (level, source, message) -> {'count', 'locations'}
+    
+    def clear(self):
+        self.entries.clear()
+    
+    def error(self, source, message, location=None):
+        self._record('error', source, message, location)
+    
+    def warning(self, source, message, location=None):
+        self._record('warning', source, message, location)
+    
+    def _record(self, level, source, message, location):
+        key = (level, source, str(message))
+        entry = self.entries.setdefault(key, {'count': 0, 'locations': []})
+        entry['count'] += 1
+        if location is not None and len(entry['locations']) < self.MAX_LOCATIONS:
+            entry['locations'].append(str(location))
+    
+    @property
+    def error_count(self):
+        return sum(e['count'] for (level, _, _), e in self.entries.items() if level == 'error')
+    
+    @property
+    def warning_count(self):
+        return sum(e['count'] for (level, _, _), e in self.entries.items() if level == 'warning')
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def summary(self):
+        """Aggregated diagnostics as a list of rows, most frequent first"""
+        rows = []
+        for (level, source, message), entry in self.entries.items():
+            locations = ', '.join(entry['locations'])
+            if entry['count'] > len(entry['locations']) and entry['locations']:
+                locations += ', ...'
+            rows.append({
+                'level': level,
+                'source': source,
+                'message': message,
+                'count': entry['count'],
+                'locations': locations
+            })
+        return sorted(rows, key=lambda row: (row['level'] != 'error', -row['count']))
+    
+    def to_dataframe(self):
+        return pd.DataFrame(self.summary(), columns=['level', 'source', 'message', 'count', 'locations'])
+
+# Persistent store of learned label -> data column matches
+MAPPING_MEMORY_PATH = os.environ.get('MAPPING_MEMORY_PATH', 'mapping_memory.json')
+
+class MappingMemory:
+    """Learned label/column matches resolved by exact lookup before similarity scoring"""
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}  # normalized label -> {normalized column -> entry}
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+    
+    @staticmethod
+    def normalize(text):
+        if text is None:
+            return ""
+        return re.sub(r'[^0-9a-z]+', ' ', str(text).lower()).strip()
+    
+    def __len__(self):
+        return sum(len(columns) for columns in self.entries.values())
+    
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+    
+    def lookup(self, label, column_index, min_similarity=0.0, count=True):
+        """Return (column, entry) for a remembered match present in column_index, else (None, None)
+        
+        column_index maps normalized column names to the original data columns.
+        Accepted (unconfirmed) matches only count if their similarity reaches
+        min_similarity. Confirmed matches win over accepted ones, then the most
+        frequently used. With count=False the lookup is left out of the hit rate.
+        """
+        known = self.entries.get(self.normalize(label))
+        best = None
+        if known:
+            for norm_column, entry in known.items():
+                if not entry.get('confirmed', False) and entry.get('similarity', 0.0) < min_similarity:
+                    continue
+                if norm_column in column_index:
+                    rank = (entry.get('confirmed', False), entry.get('count', 0))
+                    if best is None or rank > best[0]:
+                        best = (rank, column_index[norm_column], entry)
+        if best is None:
+            if count:
+                self.misses += 1
+            return None, None
+        if count:
+            self.hits += 1
+        return best[1], best[2]
+    
+    def record(self, label, column, similarity, confirmed=False):
+        """Remember an accepted (or user confirmed) match"""
+        norm_label = self.normalize(label)
+        norm_column = self.normalize(column)
+        if not norm_label or not norm_column:
+            return
+        entry = self.entries.setdefault(norm_label, {}).setdefault(norm_column, {
+            'label': str(label),
+            'column': str(column),
+            'similarity': 0.0,
+            'count': 0,
+            'confirmed': False
+        })
+        entry['count'] += 1
+        entry['similarity'] = max(entry['similarity'], float(similarity))
+        entry['confirmed'] = entry['confirmed'] or confirmed
+        entry['last_used'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    def forget(self, label, column):
+        known = self.entries.get(self.normalize(label), {})
+        known.pop(self.normalize(column), None)
+    
+    def merge(self, entries):
+        """Merge another memory's entries into this one"""
+        for norm_label, columns in entries.items():
+            for norm_column, other in columns.items():
+                entry = self.entries.setdefault(norm_label, {}).get(norm_column)
+                if entry is None:
+                    self.entries[norm_label][norm_column] = dict(other)
+                else:
+                    entry['count'] = max(entry.get('count', 0), other.get('count', 0))
+                    entry['similarity'] = max(entry.get('similarity', 0.0), other.get('similarity', 0.0))
+                    entry['confirmed'] = entry.get('confirmed', False) or other.get('confirmed', False)
+                    entry['last_used'] = max(entry.get('last_used', ''), other.get('last_used', ''))
+    
+    def export_json(self):
+        return json.dumps({'version': 1, 'entries': self.entries}, indent=2)
+    
+    def import_json(self, text):
+        """Merge entries from an exported memory, returns the number of matches imported"""
+        data = json.loads(text)
+        entries = data.get('entries', {})
+        self.merge(entries)
+        return sum(len(columns) for columns in entries.values())
+    
+    def load(self):
+        try:
+            if self.path and os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as memory_file:
+                    self.entries = json.load(memory_file).get('entries', {})
+        except Exception as e:
+            print(f"Warning: Could not load mapping memory from {self.path}: {e}")
+    
+    def save(self):
+        """Write the memory to disk, merging matches saved by other sessions first"""
+        if not self.path:
+            return
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as memory_file:
+                    self.merge(json.load(memory_file).get('entries', {}))
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile('w', delete=False, dir=directory, suffix='.tmp',
+                                             encoding='utf-8') as tmp_file:
+                tmp_file.write(self.export_json())
+            os.replace(tmp_file.name, self.path)
+        except Exception as e:
+            print(f"Warning: Could not save mapping memory to {self.path}: {e}")
+
+class ColumnTokenIndex:
+    """Inverted index from keywords and character n-grams to data columns
+    
+    Used to prune similarity scoring on very wide data sheets: a label is only
+    scored against columns sharing at least one token with it.
+    """
+    NGRAM_SIZE = 3
+    
+    def __init__(self, columns, stop_words=frozenset()):
+        self.columns = list(columns)
+        self.stop_words = stop_words
+        self.postings = {}  # token -> set of column positions
+        for position, column in enumerate(self.columns):
+            for token in self.tokens(column):
+                self.postings.setdefault(token, set()).add(position)
+    
+    def tokens(self, text):
+        tokens = set()
+        for word in MappingMemory.normalize(text).split():
+            if word in self.stop_words:
+                continue
+            tokens.add(word)
+            for start in range(len(word) - self.NGRAM_SIZE + 1):
+                tokens.add('#' + word[start:start + self.NGRAM_SIZE])
+        return tokens
+    
+    def candidates(self, label):
+        """Columns sharing a token with the label, in header order (empty if none)"""
+        positions = set()
+        for token in self.tokens(label):
+            positions.update(self.postings.get(token, ()))
+        return [self.columns[position] for position in sorted(positions)]
+
+class FieldRecord:
+    """Read-only, dict-like view of one cell in a TemplateFieldStore"""
+    __slots__ = ('_store', '_index')
+    
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+    
+    def __getitem__(self, key):
+        return self._store.field_value(self._index, key)
+    
+    def get(self, key, default=None):
+        try:
+            return self._store.field_value(self._index, key)
+        except KeyError:
+            return default
+    
+    def __contains__(self, key):
+        return key in TemplateFieldStore.KEYS
+    
+    def __iter__(self):
+        return iter(TemplateFieldStore.KEYS)
+    
+    def __len__(self):
+        return len(TemplateFieldStore.KEYS)
+    
+    def keys(self):
+        return TemplateFieldStore.KEYS
+    
+    def items(self):
+        return [(key, self[key]) for key in TemplateFieldStore.KEYS]
+    
+    def __eq__(self, other):
+        return dict(self.items()) == (dict(other.items()) if hasattr(other, 'items') else other)
+    
+    def __repr__(self):
+        return f"FieldRecord({dict(self.items())!r})"
+
+class TemplateFieldStore:
+    """Compact, read-only store of analyzed template fields
+    
+    Rows, columns and ids are kept in typed arrays; cell text, cell types,
+    merged ranges and sections are interned into small tables. Behaves like the
+    coordinate -> field dict produced during analysis, with FieldRecord values.
+    """
+    KEYS = ('value', 'row', 'column', 'merged_range', 'is_label', 'is_data_cell', 'cell_type', 'section')
+    MAGIC = b'TFS2'
+    TYPECODES = ('I', 'I', 'I', 'B', 'i', 'i')
+    
+    def __init__(self, rows=None, columns=None, value_ids=None, type_ids=None, merged_ids=None,
+                 section_ids=None, value_table=None, type_table=None, merged_table=None, section_table=None):
+        self.rows = rows if rows is not None else array('I')
+        self.columns = columns if columns is not None else array('I')
+        self.value_ids = value_ids if value_ids is not None else array('I')
+        self.type_ids = type_ids if type_ids is not None else array('B')
+        self.merged_ids = merged_ids if merged_ids is not None else array('i')  # -1: not merged
+        self.section_ids = section_ids if section_ids is not None else array('i')  # -1: no section
+        self.value_table = value_table if value_table is not None else []
+        self.type_table = type_table if type_table is not None else []
+        self.merged_table = merged_table if merged_table is not None else []
+        self.section_table = section_table if section_table is not None else []
+        self._positions = None  # coordinate -> index, built on first lookup
+    
+    @classmethod
+    def from_fields(cls, fields):
+        """Build a store from a coordinate -> field dict"""
+        store = cls()
+        tables = {}
+        
+        def intern(table, value):
+            lookup = tables.setdefault(id(table), {})
+            if value not in lookup:
+                lookup[value] = len(table)
+                table.append(value)
+            return lookup[value]
+        
+        for field in fields.values():
+            store.rows.append(field['row'])
+            store.columns.append(field['column'])
+            store.value_ids.append(intern(store.value_table, field['value']))
+            store.type_ids.append(intern(store.type_table, field.get('cell_type')))
+            merged_range = field.get('merged_range')
+            store.merged_ids.append(intern(store.merged_table, merged_range) if merged_range else -1)
+            section = field.get('section')
+            store.section_ids.append(intern(store.section_table, section) if section else -1)
+        return store
+    
+    def field_value(self, index, key):
+        if key == 'value':
+            return self.value_table[self.value_ids[index]]
+        if key == 'row':
+            return self.rows[index]
+        if key == 'column':
+            return self.columns[index]
+        if key == 'cell_type':
+            return self.type_table[self.type_ids[index]]
+        if key == 'is_label':
+            return self.type_table[self.type_ids[index]] == 'field_header'
+        if key == 'is_data_cell':
+            return self.type_table[self.type_ids[index]] == 'data_cell'
+        if key == 'merged_range':
+            merged_id = self.merged_ids[index]
+            return self.merged_table[merged_id] if merged_id >= 0 else None
+        if key == 'section':
+            section_id = self.section_ids[index]
+            return self.section_table[section_id] if section_id >= 0 else None
+        raise KeyError(key)
+    
+    def coordinate(self, index):
+        return f"{get_column_letter(self.columns[index])}{self.rows[index]}"
+    
+    @property
+    def positions(self):
+        if self._positions is None:
+            self._positions = {self.coordinate(index): index for index in range(len(self.rows))}
+        return self._positions
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    def __contains__(self, coord):
+        return coord in self.positions
+    
+    def __getitem__(self, coord):
+        return FieldRecord(self, self.positions[coord])
+    
+    def get(self, coord, default=None):
+        index = self.positions.get(coord)
+        return default if index is None else FieldRecord(self, index)
+    
+    def __iter__(self):
+        return (self.coordinate(index) for index in range(len(self.rows)))
+    
+    def keys(self):
+        return list(self)
+    
+    def values(self):
+        return [FieldRecord(self, index) for index in range(len(self.rows))]
+    
+    def items(self):
+        return [(self.coordinate(index), FieldRecord(self, index)) for index in range(len(self.rows))]
+    
+    def to_dict(self):
+        """Plain coordinate -> field dict, as produced during analysis"""
+        return {coord: dict(record.items()) for coord, record in self.items()}
+    
+    def to_bytes(self):
+        """Binary form, little-endian regardless of host
+        
+        MAGIC, the field count (uint32), the item size of each typed array (one
+        byte each), the arrays back to back, then the interned tables as JSON.
+        """
+        arrays = (self.rows, self.columns, self.value_ids, self.type_ids, self.merged_ids, self.section_ids)
+        tables = json.dumps([self.value_table, self.type_table, self.merged_table, self.section_table],
+                            ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        parts = [self.MAGIC, struct.pack('<I', len(self.rows)), bytes(column.itemsize for column in arrays)]
+        for column in arrays:
+            if sys.byteorder == 'big' and column.itemsize > 1:
+                column = array(column.typecode, column)
+                column.byteswap()
+            parts.append(column.tobytes())
+        parts.append(tables)
+        return b''.join(parts)
+    
+    @classmethod
+    def from_bytes(cls, data):
+        data = memoryview(data)
+        if bytes(data[:4]) != cls.MAGIC:
+            raise ValueError("Not a serialized TemplateFieldStore")
+        count = struct.unpack_from('<I', data, 4)[0]
+        itemsizes = bytes(data[8:8 + len(cls.TYPECODES)])
+        offset = 8 + len(cls.TYPECODES)
+        arrays = []
+        for typecode, itemsize in zip(cls.TYPECODES, itemsizes):
+            column = array(typecode)
+            if column.itemsize != itemsize:
+                raise ValueError(f"TemplateFieldStore was written with {itemsize}-byte '{typecode}' items; "
+                                 f"this platform uses {column.itemsize}")
+            size = count * itemsize
+            column.frombytes(data[offset:offset + size])
+            if sys.byteorder == 'big' and itemsize > 1:
+                column.byteswap()
+            arrays.append(column)
+            offset += size
+        value_table, type_table, merged_table, section_table = json.loads(bytes(data[offset:]).decode('utf-8'))
+        return cls(*arrays, value_table=value_table, type_table=type_table,
+                   merged_table=merged_table, section_table=section_table)
+    
+    def __reduce__(self):
+        return (self.from_bytes, (self.to_bytes(),))
+
+class AdvancedTemplateMapper:
+    # Headers at least this wide are scored through a ColumnTokenIndex
+    COLUMN_INDEX_MIN_COLUMNS = 50
+    # How far below / right of a label find_data_cell_for_label looks for its value cell
+    SEARCH_ROWS = 3
+    SEARCH_COLUMNS = 5
+    
+    def __init__(self, resources=None):
+        # Per-session settings; NLP state and caches are shared through self.resources
+        self.similarity_threshold = 0.3
+        self.diagnostics = MappingDiagnostics()
+        self.mapping_memory = None
+        self.use_column_index = True
+        self.resources = resources or get_shared_resources()
+        self.stop_words = self.resources.stop_words
         self.section_mappings = {
             'primary_packaging': {
                 'section_keywords': ['primary packaging instruction', 'primary', 'internal'],
@@ -113,12 +623,12 @@ class AdvancedTemplateMapper:
                 }
             }
         }
-        if ADVANCED_NLP:
-            try:
-                self.stop_words = set(stopwords.words('english'))
-                self.vectorizer = TfidfVectorizer(stop_words='english', ngram_range=(1, 2))
-            except:
-                pass
+        # Section field labels normalized the same way as data column names
+        self.section_field_index = {
+            section: {MappingMemory.normalize(label): column
+                      for label, column in config['field_mappings'].items()}
+            for section, config in self.section_mappings.items()
+        }
         
     def preprocess_text(self, text):
         """Preprocess text for better matching"""
@@ -132,7 +642,7 @@ class AdvancedTemplateMapper:
             
             return text
         except Exception as e:
-            st.error(f"Error in preprocess_text: {e}")
+            self.diagnostics.error('preprocess_text', e)
             return ""
     
     def extract_keywords(self, text):
@@ -149,13 +659,13 @@ class AdvancedTemplateMapper:
                     return keywords
                 except Exception as e:
                     # If NLTK fails, fall back to simple tokenization
-                    print(f"NLTK tokenization failed, using fallback: {e}")
+                    self.diagnostics.warning('extract_keywords', f"NLTK tokenization failed, using fallback: {e}")
             # Fallback: Simple tokenization
             tokens = text.split()
             keywords = [token for token in tokens if token not in self.stop_words and len(token) > 2]
             return keywords
         except Exception as e:
-            st.error(f"Error in extract_keywords: {e}")
+            self.diagnostics.error('extract_keywords', e)
             return []
             
     def simple_tokenize(text):
@@ -177,6 +687,11 @@ class AdvancedTemplateMapper:
             if not text1 or not text2:
                 return 0.0
             
+            cache_key = (text1, text2)
+            cached = self.resources.similarity_cache.get(cache_key)
+            if cached is not None:
+                return cached
+            
             # Sequence similarity
             sequence_sim = SequenceMatcher(None, text1, text2).ratio()
             
@@ -184,7 +699,7 @@ class AdvancedTemplateMapper:
             tfidf_sim = 0.0
             if ADVANCED_NLP:
                 try:
-                    tfidf_matrix = self.vectorizer.fit_transform([text1, text2])
+                    tfidf_matrix = clone(self.resources.vectorizer).fit_transform([text1, text2])
                     tfidf_sim = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
                 except:
                     tfidf_sim = 0.0
@@ -204,9 +719,10 @@ class AdvancedTemplateMapper:
             else:
                 final_similarity = (sequence_sim * 0.7) + (keyword_sim * 0.3)
             
+            self.resources.similarity_cache.put(cache_key, final_similarity)
             return final_similarity
         except Exception as e:
-            st.error(f"Error in calculate_similarity: {e}")
+            self.diagnostics.error('calculate_similarity', e)
             return 0.0
     
     def is_data_cell(self, cell_value):
@@ -219,17 +735,11 @@ class AdvancedTemplateMapper:
             if not cell_str:
                 return True
             
-            # Data placeholder patterns
-            data_patterns = [
-                r'^_+$', r'^\.*$', r'^-+$', r'^\[.*\]$', r'^\{.*\}$', r'^<.*>$',
-                r'enter|fill|data|value|input|here|placeholder', r'^\d{1,2}/\d{1,2}/\d{2,4}$',
-                r'^dd/mm/yyyy|mm/dd/yyyy|yyyy-mm-dd$', r'^\$\d*\.?\d*$', r'^\d*\.?\d*$',
-            ]
-            
             cell_lower = cell_str.lower()
             
-            for pattern in data_patterns:
-                if re.search(pattern, cell_lower):
+            # Data placeholder patterns
+            for pattern in self.resources.data_patterns:
+                if pattern.search(cell_lower):
                     return True
             
             # Special character dominated cells
@@ -238,7 +748,7 @@ class AdvancedTemplateMapper:
             
             return False
         except Exception as e:
-            st.error(f"Error in is_data_cell: {e}")
+            self.diagnostics.error('is_data_cell', e)
             return False
     
     def is_section_header(self, text):
@@ -269,7 +779,7 @@ class AdvancedTemplateMapper:
                 
             return False
         except Exception as e:
-            st.error(f"Error in is_section_header: {e}")
+            self.diagnostics.error('is_section_header', e)
             return False
     
     def is_table_header(self, text):
@@ -294,12 +804,12 @@ class AdvancedTemplateMapper:
                 if pattern in text_lower:
                     return True
             
-            if re.search(r'mm|cm|kg|gm|pcs|qty|pack|dimension|weight|size', text_lower):
+            if self.resources.table_unit_pattern.search(text_lower):
                 return True
                 
             return False
         except Exception as e:
-            st.error(f"Error in is_table_header: {e}")
+            self.diagnostics.error('is_table_header', e)
             return False
     
     def is_label_cell(self, text):
@@ -344,7 +854,7 @@ class AdvancedTemplateMapper:
             
             return False
         except Exception as e:
-            st.error(f"Error in is_label_cell: {e}")
+            self.diagnostics.error('is_label_cell', e)
             return False
     
     def classify_cell_type(self, cell_value):
@@ -358,6 +868,20 @@ class AdvancedTemplateMapper:
             if not text:
                 return 'data_cell'
             
+            # Classification depends only on the text, so it is shared across sessions
+            cell_type = self.resources.classification_cache.get(text)
+            if cell_type is None:
+                cell_type = self.classify_text(text)
+                self.resources.classification_cache.put(text, cell_type)
+            return cell_type
+            
+        except Exception as e:
+            self.diagnostics.error('classify_cell_type', e)
+            return 'data_cell'
+    
+    def classify_text(self, text):
+        """Uncached classification of non-empty, stripped cell text"""
+        try:
             text_lower = text.lower()
             
             if self.is_data_cell(text):
@@ -389,105 +913,432 @@ class AdvancedTemplateMapper:
             return 'data_cell'
             
         except Exception as e:
-            st.error(f"Error in classify_cell_type: {e}")
+            self.diagnostics.error('classify_text', e)
             return 'data_cell'
     
     def find_template_fields(self, template_file):
         """Find all template fields with automatic classification"""
-        fields = {}
+        return self.analyze_template(template_file)['fields']
+    
+    @staticmethod
+    def structural_fingerprint(cells, merged_ranges):
+        """Hash of a template's layout: populated cell positions, value kinds and merged geometry
+        
+        Cell text is left out so that forms differing only in titles, logos or
+        version text share a fingerprint.
+        """
+        digest = hashlib.sha1()
+        for coord in sorted(cells, key=lambda c: (cells[c]['row'], cells[c]['column'])):
+            cell = cells[coord]
+            digest.update(f"{cell['row']},{cell['column']},{cell['kind']};".encode())
+        digest.update('|'.join(sorted(str(r) for r in merged_ranges)).encode())
+        return digest.hexdigest()
+    
+    @staticmethod
+    def populated_cells(worksheet):
+        """Cells holding a non-blank value, in row-major order
+        
+        Reads the worksheet's stored cells directly: iter_rows() walks (and creates)
+        every cell of the declared dimension, which formatting alone can stretch to
+        millions of empty cells.
+        """
+        cells = []
+        for _, cell in sorted(worksheet._cells.items()):
+            if cell.value is not None and str(cell.value).strip():
+                cells.append(cell)
+        return cells
+    
+    def find_used_range(self, worksheet, populated=None):
+        """Real content bounds (populated cells and merged ranges) against the declared sheet size"""
+        if populated is None:
+            populated = self.populated_cells(worksheet)
+        
+        rows = [cell.row for cell in populated]
+        cols = [cell.column for cell in populated]
+        for merged_range in worksheet.merged_cells.ranges:
+            min_col, min_row, max_col, max_row = merged_range.bounds
+            rows += [min_row, max_row]
+            cols += [min_col, max_col]
+        
+        if not rows:
+            return {'ref': None, 'min_row': 1, 'min_col': 1, 'max_row': 0, 'max_col': 0,
+                    'sheet_rows': worksheet.max_row, 'sheet_cols': worksheet.max_column, 'skipped_cells': 0}
+        
+        min_row, max_row, min_col, max_col = min(rows), max(rows), min(cols), max(cols)
+        used_cells = (max_row - min_row + 1) * (max_col - min_col + 1)
+        return {
+            'ref': f"{get_column_letter(min_col)}{min_row}:{get_column_letter(max_col)}{max_row}",
+            'min_row': min_row,
+            'min_col': min_col,
+            'max_row': max_row,
+            'max_col': max_col,
+            'sheet_rows': worksheet.max_row,
+            'sheet_cols': worksheet.max_column,
+            'skipped_cells': max(worksheet.max_row * worksheet.max_column - used_cells, 0)
+        }
+    
+    def search_bounds(self, used_range):
+        """(max_row, max_col) limits for the value-cell search
+        
+        The used range widened by the search radius, so blank (e.g. bordered)
+        value cells just past the content are still found; clamped to the
+        declared sheet size.
+        """
+        return (min(used_range['max_row'] + self.SEARCH_ROWS, used_range['sheet_rows']),
+                min(used_range['max_col'] + self.SEARCH_COLUMNS, used_range['sheet_cols']))
+    
+    def analyze_template(self, template_file):
+        """Classify template cells and resolve the fill plan, reusing cached work for known layouts
+        
+        Returns a dict with 'fields' (a TemplateFieldStore), 'fill_plan' (label
+        coordinate -> target cell), 'fingerprint', 'used_range', 'merged_ranges' and
+        the number of 'reused_cells' and 'reanalyzed_cells'.
+        """
+        analysis = {'fields': {}, 'fill_plan': {}, 'fingerprint': None, 'used_range': None,
+                    'merged_ranges': [], 'reused_cells': 0, 'reanalyzed_cells': 0}
+        fields = analysis['fields']
         
         try:
             workbook = openpyxl.load_workbook(template_file)
             worksheet = workbook.active
             
             merged_ranges = worksheet.merged_cells.ranges
+            analysis['merged_ranges'] = [str(merged_range) for merged_range in merged_ranges]
+            
+            # Collect populated cells (only within the used range)
+            populated = self.populated_cells(worksheet)
+            used_range = self.find_used_range(worksheet, populated)
+            analysis['used_range'] = used_range
+            cells = {}
+            for cell in populated:
+                if isinstance(cell.value, datetime):
+                    kind = 'd'
+                elif isinstance(cell.value, (int, float)):
+                    kind = 'n'
+                else:
+                    kind = 's'
+                cells[cell.coordinate] = {'value': str(cell.value).strip(), 'row': cell.row,
+                                          'column': cell.column, 'kind': kind}
             
-            for row in worksheet.iter_rows():
-                for cell in row:
-                    try:
-                        if cell.value is not None:
-                            cell_value = str(cell.value).strip()
-                            
-                            if cell_value:
-                                cell_coord = cell.coordinate
-                                merged_range = None
-                                
-                                for merge_range in merged_ranges:
-                                    if cell.coordinate in merge_range:
-                                        merged_range = str(merge_range)
-                                        break
-                                
-                                cell_type = self.classify_cell_type(cell_value)
-                                
-                                fields[cell_coord] = {
-                                    'value': cell_value,
-                                    'row': cell.row,
-                                    'column': cell.column,
-                                    'merged_range': merged_range,
-                                    'is_label': cell_type == 'field_header',
-                                    'is_data_cell': cell_type == 'data_cell',
-                                    'cell_type': cell_type
-                                }
-                    except Exception as e:
-                        st.error(f"Error processing cell {cell.coordinate}: {e}")
+            fingerprint = self.structural_fingerprint(cells, merged_ranges)
+            cached = self.resources.template_cache.get(fingerprint)
+            analysis['fingerprint'] = fingerprint
+            
+            changed_cells = []
+            for cell_coord, cell in cells.items():
+                try:
+                    # Same layout and same text: the cached classification still holds
+                    if cached and cached['values'].get(cell_coord) == cell['value']:
+                        fields[cell_coord] = dict(cached['fields'][cell_coord])
+                        analysis['reused_cells'] += 1
                         continue
+                    
+                    merged_range = None
+                    
+                    for merge_range in merged_ranges:
+                        if cell_coord in merge_range:
+                            merged_range = str(merge_range)
+                            break
+                    
+                    cell_type = self.classify_cell_type(cell['value'])
+                    
+                    fields[cell_coord] = {
+                        'value': cell['value'],
+                        'row': cell['row'],
+                        'column': cell['column'],
+                        'merged_range': merged_range,
+                        'is_label': cell_type == 'field_header',
+                        'is_data_cell': cell_type == 'data_cell',
+                        'cell_type': cell_type
+                    }
+                    changed_cells.append(cell)
+                    analysis['reanalyzed_cells'] += 1
+                except Exception as e:
+                    self.diagnostics.error('find_template_fields', e, location=cell_coord)
+                    continue
+            
+            self.build_region_index(fields)
+            
+            # Reuse fill plan targets whose search neighbourhood did not change
+            reusable_plan = {}
+            if cached:
+                for coord, target in cached['fill_plan'].items():
+                    if coord in fields and not self.fill_plan_affected(fields[coord], changed_cells):
+                        reusable_plan[coord] = target
+            analysis['fill_plan'] = self.build_fill_plan(
+                worksheet, fields, reusable_plan, bounds=self.search_bounds(used_range)
+            )
             
             workbook.close()
             
+            analysis['fields'] = TemplateFieldStore.from_fields(fields)
+            self.resources.template_cache.put(fingerprint, {
+                'values': {coord: cell['value'] for coord, cell in cells.items()},
+                'fields': analysis['fields'],
+                'fill_plan': dict(analysis['fill_plan'])
+            })
+            
+        except Exception as e:
+            self.diagnostics.error('find_template_fields', f"Error reading template: {e}")
+        
+        if not isinstance(analysis['fields'], TemplateFieldStore):
+            analysis['fields'] = TemplateFieldStore.from_fields(fields)
+        return analysis
+    
+    @staticmethod
+    def fill_plan_affected(field, changed_cells):
+        """Whether a changed cell falls inside the area find_data_cell_for_label searches for a label"""
+        max_col = field['column'] + 5
+        if field.get('merged_range'):
+            max_col = max(max_col, range_boundaries(field['merged_range'])[2] + 3)
+        for cell in changed_cells:
+            if (field['row'] - 1 <= cell['row'] <= field['row'] + 3 and
+                    field['column'] - 1 <= cell['column'] <= max_col):
+                return True
+        return False
+    
+    def is_fill_candidate(self, field):
+        """Fields that can receive mapped data: labels and section table headers"""
+        return (field.get('cell_type') == 'field_header' or field.get('is_label') == True or
+                self.section_column_for(field) is not None)
+    
+    def build_fill_plan(self, worksheet, fields, known_targets=None, bounds=None):
+        """Resolve the data cell for every fillable field once, at analysis time
+        
+        Targets already claimed by an earlier label are not handed out twice;
+        bounds (max_row, max_col) limits the neighbour search to the used range.
+        """
+        known_targets = known_targets or {}
+        fill_plan = {}
+        claimed = set(target for target in known_targets.values() if target)
+        for coord, field in fields.items():
+            try:
+                if not self.is_fill_candidate(field):
+                    continue
+                if coord in known_targets:
+                    fill_plan[coord] = known_targets[coord]
+                    continue
+                target = self.find_data_cell_for_label(worksheet, field, claimed, bounds)
+                fill_plan[coord] = target
+                if target:
+                    claimed.add(target)
+            except Exception as e:
+                self.diagnostics.error('build_fill_plan', e, location=coord)
+        return fill_plan
+    
+    def match_section(self, text):
+        """Return the section_mappings key whose keywords best match a section header"""
+        text_lower = str(text).lower()
+        best_section = None
+        best_length = 0
+        for section, config in self.section_mappings.items():
+            for keyword in config['section_keywords']:
+                if len(keyword) > best_length and re.search(r'\b' + re.escape(keyword) + r'\b', text_lower):
+                    best_section = section
+                    best_length = len(keyword)
+        return best_section
+    
+    def build_region_index(self, fields):
+        """Assign every field the section whose header region encloses it
+        
+        Each section header starts a region spanning its merged columns (or up to the
+        next header in the same row) and running down to the next header that
+        overlaps those columns. Headers that match no section_mappings entry still
+        close the region above them.
+        """
+        regions = []
+        try:
+            anchors = sorted((field for field in fields.values() if field.get('cell_type') == 'section_header'),
+                             key=lambda field: (field['row'], field['column']))
+            
+            for anchor in anchors:
+                if anchor.get('merged_range'):
+                    min_col, _, max_col, _ = range_boundaries(anchor['merged_range'])
+                else:
+                    min_col = anchor['column']
+                    right = [a['column'] for a in anchors if a['row'] == anchor['row'] and a['column'] > min_col]
+                    max_col = min(right) - 1 if right else float('inf')
+                regions.append({
+                    'section': self.match_section(anchor['value']),
+                    'header': anchor['value'],
+                    'min_row': anchor['row'],
+                    'max_row': float('inf'),
+                    'min_col': min_col,
+                    'max_col': max_col
+                })
+            
+            for region in regions:
+                for other in regions:
+                    if (other['min_row'] > region['min_row'] and
+                            other['min_col'] <= region['max_col'] and other['max_col'] >= region['min_col']):
+                        region['max_row'] = min(region['max_row'], other['min_row'] - 1)
+            
+            for field in fields.values():
+                enclosing = None
+                for region in regions:
+                    if (region['min_row'] <= field['row'] <= region['max_row'] and
+                            region['min_col'] <= field['column'] <= region['max_col']):
+                        if enclosing is None or region['min_row'] > enclosing['min_row']:
+                            enclosing = region
+                field['section'] = enclosing['section'] if enclosing else None
+                
         except Exception as e:
-            st.error(f"Error reading template: {e}")
+            self.diagnostics.error('build_region_index', e)
+        
+        return regions
+    
+    def section_column_for(self, field):
+        """Data column name that section_mappings assigns to a field, if any"""
+        section = field.get('section')
+        if not section:
+            return None
+        return self.section_field_index.get(section, {}).get(MappingMemory.normalize(field.get('value')))
+    
+    def worker_copy(self):
+        """Mapper with this one's settings, resources and mapping memory but its own diagnostics
         
-        return fields
+        For background threads, which must not share the session mapper's diagnostics.
+        """
+        mapper = AdvancedTemplateMapper(self.resources)
+        mapper.similarity_threshold = self.similarity_threshold
+        mapper.mapping_memory = self.mapping_memory
+        mapper.use_column_index = self.use_column_index
+        return mapper
     
-    def map_data_to_template(self, template_fields, data_df):
-        """Automatically map data columns to template fields"""
+    def map_data_to_template(self, template_fields, data_df, remember=True):
+        """Automatically map data columns to template fields
+        
+        With remember=False, similarity matches are not written to the mapping
+        memory and lookups are not counted in its hit rate; remember_matches()
+        does both later.
+        """
         mapping_results = {}
         try:
             data_columns = data_df.columns.tolist()
+            memory = self.mapping_memory
+            column_index = {MappingMemory.normalize(col): col for col in data_columns}
+            
+            # Wide headers: prune candidates through a token index built once per header
+            token_index = None
+            if self.use_column_index and len(data_columns) >= self.COLUMN_INDEX_MIN_COLUMNS:
+                token_index = self.column_token_index(data_columns)
+            
+            # Section fields (e.g. Primary L-mm) resolve directly through section_mappings
+            section_columns = {}
+            for coord, field in template_fields.items():
+                section_column = self.section_column_for(field)
+                if section_column and MappingMemory.normalize(section_column) in column_index:
+                    section_columns[coord] = column_index[MappingMemory.normalize(section_column)]
             
             mappable_fields = {coord: field for coord, field in template_fields.items()
-                               if field.get('cell_type') == 'field_header' or field.get('is_label') == True}
+                               if field.get('cell_type') == 'field_header' or field.get('is_label') == True
+                               or coord in section_columns}
             
             for coord, field in mappable_fields.items():
                 try:
                     best_match = None
                     best_score = 0.0
+                    match_source = None
+                    
+                    if coord in section_columns:
+                        best_match = section_columns[coord]
+                        best_score = 1.0
+                        match_source = 'section'
                     
-                    for data_col in data_columns:
-                        similarity = self.calculate_similarity(field['value'], data_col)
+                    # A column named exactly like the label beats anything remembered
+                    norm_label = MappingMemory.normalize(field['value'])
+                    if best_match is None and norm_label:
+                        best_match = column_index.get(norm_label)
+                        if best_match is not None:
+                            best_score = 1.0
+                            match_source = 'exact'
+                    
+                    # Fast path: known label/column pairs resolve by exact lookup
+                    if best_match is None and memory is not None:
+                        best_match, entry = memory.lookup(field['value'], column_index, self.similarity_threshold,
+                                                          count=remember)
+                        if best_match is not None:
+                            best_score = entry.get('similarity', 1.0)
+                            match_source = 'memory'
+                    
+                    if best_match is None:
+                        candidates = data_columns
+                        if token_index is not None:
+                            # Fall back to a full scan when no column shares a token
+                            candidates = token_index.candidates(field['value']) or data_columns
                         
-                        if similarity > best_score and similarity >= self.similarity_threshold:
-                            best_score = similarity
-                            best_match = data_col
+                        for data_col in candidates:
+                            similarity = self.calculate_similarity(field['value'], data_col)
+                            
+                            if similarity > best_score and similarity >= self.similarity_threshold:
+                                best_score = similarity
+                                best_match = data_col
+                        
+                        if best_match is not None:
+                            match_source = 'similarity'
+                            if memory is not None and remember:
+                                memory.record(field['value'], best_match, best_score)
                     
                     mapping_results[coord] = {
                         'template_field': field['value'],
                         'data_column': best_match,
                         'similarity': best_score,
-                        'field_info': field,
-                        'is_mappable': best_match is not None
+                        'field_info': dict(field),
+                        'is_mappable': best_match is not None,
+                        'match_source': match_source
                     }
                         
                 except Exception as e:
-                    st.error(f"Error mapping field {coord}: {e}")
+                    self.diagnostics.error('map_data_to_template', e, location=coord)
                     continue
                     
         except Exception as e:
-            st.error(f"Error in map_data_to_template: {e}")
+            self.diagnostics.error('map_data_to_template', e)
             
         return mapping_results
     
-    def find_data_cell_for_label(self, worksheet, field_info):
-        """Automatically find data cell for a label (improved merged cell handling)"""
+    def remember_matches(self, mapping_results):
+        """Record the similarity matches and memory lookups of a mapping run made with remember=False"""
+        memory = self.mapping_memory
+        if memory is None:
+            return
+        for mapping in mapping_results.values():
+            source = mapping.get('match_source')
+            if source == 'memory':
+                memory.hits += 1
+            elif source in ('similarity', None):
+                # These reached the memory lookup and missed
+                memory.misses += 1
+                if source == 'similarity':
+                    memory.record(mapping['template_field'], mapping['data_column'], mapping['similarity'])
+    
+    def column_token_index(self, data_columns):
+        """ColumnTokenIndex for a data header, shared across sessions and runs"""
+        key = hashlib.sha1(json.dumps([str(col) for col in data_columns]).encode()).hexdigest()
+        token_index = self.resources.column_index_cache.get(key)
+        if token_index is None:
+            token_index = ColumnTokenIndex(data_columns, self.stop_words)
+            self.resources.column_index_cache.put(key, token_index)
+        return token_index
+    
+    def find_data_cell_for_label(self, worksheet, field_info, claimed=None, bounds=None):
+        """Automatically find data cell for a label (improved merged cell handling)
+        
+        Cells in claimed (already assigned to another label) are skipped. bounds is
+        (max_row, max_col) of the used range; defaults to the declared sheet size.
+        """
         try:
             row = field_info['row']
             col = field_info['column']
+            row_limit, column_limit = bounds or (worksheet.max_row, worksheet.max_column)
             # Get merged ranges for reference
             merged_ranges = list(worksheet.merged_cells.ranges)
         
             def is_suitable_data_cell(cell_coord):
                 """Check if a cell is suitable for data entry"""
                 try:
+                    if claimed and cell_coord in claimed:
+                        return False
                     cell = worksheet[cell_coord]
                     # Skip MergedCell objects (they're read-only)
                     if hasattr(cell, '__class__') and cell.__class__.__name__ == 'MergedCell':
@@ -498,17 +1349,24 @@ class AdvancedTemplateMapper:
                     return False
                 except:
                     return False
+            # Strategy 0: Table headers (e.g. L-mm in a section table) take the value below,
+            # even when the table is the last content on the sheet
+            if field_info.get('cell_type') == 'table_header':
+                for offset in range(1, 4):
+                    cell_coord = f"{get_column_letter(col)}{row + offset}"
+                    if is_suitable_data_cell(cell_coord):
+                        return cell_coord
             # Strategy 1: Look right of label (most common pattern)
             for offset in range(1, 6):
                 target_col = col + offset
-                if target_col <= worksheet.max_column:
+                if target_col <= column_limit:
                     cell_coord = worksheet.cell(row=row, column=target_col).coordinate
                     if is_suitable_data_cell(cell_coord):
                         return cell_coord
             # Strategy 2: Look below label
             for offset in range(1, 4):
                 target_row = row + offset
-                if target_row <= worksheet.max_row:
+                if target_row <= row_limit:
                     cell_coord = worksheet.cell(row=target_row, column=col).coordinate
                     if is_suitable_data_cell(cell_coord):
                         return cell_coord
@@ -520,8 +1378,8 @@ class AdvancedTemplateMapper:
                     target_row = row + r_offset
                     target_col = col + c_offset
                 
-                    if (target_row > 0 and target_row <= worksheet.max_row and 
-                        target_col > 0 and target_col <= worksheet.max_column):
+                    if (target_row > 0 and target_row <= row_limit and 
+                        target_col > 0 and target_col <= column_limit):
                             cell_coord = worksheet.cell(row=target_row, column=target_col).coordinate
                             if is_suitable_data_cell(cell_coord):
                                 return cell_coord
@@ -542,7 +1400,7 @@ class AdvancedTemplateMapper:
                                         return cell_coord
                             # Check cells adjacent to the merged range
                             for c in range(max_col + 1, max_col + 4):
-                                if c <= worksheet.max_column:
+                                if c <= column_limit:
                                     for r in range(min_row, max_row + 1):
                                         cell_coord = worksheet.cell(row=r, column=c).coordinate
                                         if is_suitable_data_cell(cell_coord):
@@ -550,52 +1408,793 @@ class AdvancedTemplateMapper:
                             break
                         
                 except Exception as e:
-                    st.warning(f"Error processing merged range for {field_info.get('value', 'unknown')}: {e}")
+                    self.diagnostics.warning('find_data_cell_for_label', f"Error processing merged range: {e}",
+                                             location=field_info.get('merged_range'))
             return None
             
         except Exception as e:
-            st.error(f"Error in find_data_cell_for_label: {e}")
+            self.diagnostics.error('find_data_cell_for_label', e)
             return None
     
-    def fill_template_with_data(self, template_file, mapping_results, data_df):
-        """Fill template with mapped data and return the filled workbook"""
+    @staticmethod
+    def format_cell_value(value):
+        """Text written into a template cell for a data value"""
+        return str(value) if not pd.isna(value) else ""
+    
+    def fill_template_with_data(self, template_file, mapping_results, data_df, fill_plan=None):
+        """Fill template with mapped data and return the filled workbook
+        
+        fill_plan (from analyze_template) supplies pre-resolved target cells;
+        labels missing from it are resolved against the worksheet.
+        """
+        record = data_df.iloc[0].to_dict() if len(data_df) > 0 else None
+        return self.fill_template_with_record(template_file, mapping_results, record, fill_plan)
+    
+    def fill_template_with_record(self, template_file, mapping_results, record, fill_plan=None):
+        """Fill template from one record (column -> value mapping) and return the filled workbook"""
         try:
             workbook = openpyxl.load_workbook(template_file)
-            worksheet = workbook.active
-            
-            filled_count = 0
-            
-            for coord, mapping in mapping_results.items():
-                try:
-                    if mapping['data_column'] is not None and mapping['is_mappable']:
-                        field_info = mapping['field_info']
-                        
-                        target_cell = self.find_data_cell_for_label(worksheet, field_info)
-                        
-                        if target_cell and len(data_df) > 0:
-                            data_value = data_df.iloc[0][mapping['data_column']]
-                            
-                            cell_obj = worksheet[target_cell]
-                            if hasattr(cell_obj, '__class__') and cell_obj.__class__.__name__ == 'MergedCell':
-                                # Get top-left anchor of merged range
-                                for merged_range in worksheet.merged_cells.ranges:
-                                    if target_cell in merged_range:
-                                        anchor_cell = merged_range.start_cell
-                                        anchor_cell.value = str(data_value) if not pd.isna(data_value) else ""
-                                        break
-                            else:
-                                cell_obj.value = str(data_value) if not pd.isna(data_value) else ""
-                            filled_count += 1
-                            
-                except Exception as e:
-                    st.error(f"Error filling mapping {coord}: {e}")
-                    continue
-            
+            targets = self.resolve_fill_targets(workbook.active, mapping_results, fill_plan)
+            filled_count = self.write_record(workbook.active, mapping_results, record, targets)
             return workbook, filled_count
             
         except Exception as e:
-            st.error(f"Error filling template: {e}")
+            self.diagnostics.error('fill_template_with_record', f"Error filling template: {e}")
             return None, 0
+    
+    def resolve_fill_targets(self, worksheet, mapping_results, fill_plan=None):
+        """Target cell for every mapped field: from fill_plan, else searched on the worksheet"""
+        targets = {}
+        used_bounds = None
+        for coord, mapping in mapping_results.items():
+            try:
+                if mapping['data_column'] is not None and mapping['is_mappable']:
+                    if fill_plan is not None and coord in fill_plan:
+                        targets[coord] = fill_plan[coord]
+                    else:
+                        if used_bounds is None:
+                            used_bounds = self.search_bounds(self.find_used_range(worksheet))
+                        targets[coord] = self.find_data_cell_for_label(worksheet, mapping['field_info'],
+                                                                       bounds=used_bounds)
+            except Exception as e:
+                self.diagnostics.error('resolve_fill_targets', e, location=coord)
+        return targets
+    
+    def write_record(self, worksheet, mapping_results, record, targets):
+        """Write one record's mapped values into the resolved target cells; returns the number filled"""
+        filled_count = 0
+        if record is None:
+            return filled_count
+        
+        for coord, target_cell in targets.items():
+            try:
+                if not target_cell:
+                    continue
+                data_value = record.get(mapping_results[coord]['data_column'])
+                
+                cell_obj = worksheet[target_cell]
+                if hasattr(cell_obj, '__class__') and cell_obj.__class__.__name__ == 'MergedCell':
+                    # Get top-left anchor of merged range
+                    for merged_range in worksheet.merged_cells.ranges:
+                        if target_cell in merged_range:
+                            anchor_cell = merged_range.start_cell
+                            anchor_cell.value = self.format_cell_value(data_value)
+                            break
+                else:
+                    cell_obj.value = self.format_cell_value(data_value)
+                filled_count += 1
+                
+            except Exception as e:
+                self.diagnostics.error('fill_template_with_record', e, location=coord)
+                continue
+        
+        return filled_count
+
+def benchmark_candidate_pruning(template_fields, data_columns, similarity_threshold=0.3):
+    """Time map_data_to_template with and without the column token index
+    
+    Each run uses fresh NLP resources so neither benefits from the other's
+    similarity cache; section and memory lookups are disabled so only scoring
+    (and exact-name matches, which skip it) is measured. Returns timings, label/column comparison counts, the speedup
+    and the share of labels mapped to the same column by both runs.
+    """
+    header_df = pd.DataFrame(columns=list(data_columns))
+    results = {}
+    for mode in ('exhaustive', 'indexed'):
+        mapper = AdvancedTemplateMapper(resources=SharedNLPResources())
+        mapper.similarity_threshold = similarity_threshold
+        mapper.section_field_index = {}
+        mapper.use_column_index = mode == 'indexed'
+        mapper.COLUMN_INDEX_MIN_COLUMNS = 0
+        start = time.perf_counter()
+        results[mode] = mapper.map_data_to_template(template_fields, header_df)
+        results[mode + '_seconds'] = time.perf_counter() - start
+    
+    labels = list(results['exhaustive'])
+    token_index = ColumnTokenIndex(data_columns, SharedNLPResources().stop_words)
+    indexed_comparisons = sum(len(token_index.candidates(results['exhaustive'][coord]['template_field']))
+                              or len(data_columns) for coord in labels)
+    agreement = sum(1 for coord in labels
+                    if results['indexed'].get(coord, {}).get('data_column') ==
+                    results['exhaustive'][coord]['data_column'])
+    return {
+        'labels': len(labels),
+        'columns': len(data_columns),
+        'exhaustive_seconds': results['exhaustive_seconds'],
+        'indexed_seconds': results['indexed_seconds'],
+        'speedup': results['exhaustive_seconds'] / max(results['indexed_seconds'], 1e-9),
+        'exhaustive_comparisons': len(labels) * len(data_columns),
+        'indexed_comparisons': indexed_comparisons,
+        'agreement': agreement / len(labels) if labels else 1.0
+    }
+
+class DataSource:
+    """Uploaded data file read in two phases: the header row for mapping, then only the mapped columns
+    
+    CSV and Excel files are parsed with pandas. Parquet and Arrow IPC/Feather files
+    (when pyarrow is installed) are read through Arrow with column projection, and
+    their rows are iterated batch by batch without building pandas objects.
+    """
+    ARROW_FORMATS = ('parquet', 'arrow')
+    
+    def __init__(self, name, file_bytes):
+        self.name = name
+        self.file_bytes = file_bytes
+        self.key = hashlib.sha1(file_bytes).hexdigest()
+        self.format = self.detect_format(name)
+        self._columns = None
+        self._row_count = None
+    
+    @staticmethod
+    def detect_format(name):
+        suffix = Path(name).suffix.lower()
+        if suffix == '.csv':
+            return 'csv'
+        if suffix in ('.parquet', '.pq'):
+            return 'parquet'
+        if suffix in ('.arrow', '.feather', '.ipc'):
+            return 'arrow'
+        return 'excel'
+    
+    @classmethod
+    def supported_types(cls):
+        types = ['csv', 'xlsx']
+        if ARROW_AVAILABLE:
+            types += ['parquet', 'feather', 'arrow']
+        return types
+    
+    @property
+    def is_arrow(self):
+        return self.format in self.ARROW_FORMATS
+    
+    def _read(self, **kwargs):
+        if self.format == 'csv':
+            return pd.read_csv(io.BytesIO(self.file_bytes), **kwargs)
+        return pd.read_excel(io.BytesIO(self.file_bytes), **kwargs)
+    
+    def _arrow_schema(self):
+        if self.format == 'parquet':
+            return pq.read_schema(pa.BufferReader(self.file_bytes))
+        try:
+            return ipc.open_file(pa.BufferReader(self.file_bytes)).schema
+        except pa.ArrowInvalid:
+            return ipc.open_stream(pa.BufferReader(self.file_bytes)).schema
+    
+    def read_table(self, columns=None):
+        """Arrow table projected to the given columns (Arrow formats only)"""
+        if self.format == 'parquet':
+            return pq.read_table(pa.BufferReader(self.file_bytes), columns=columns)
+        try:
+            return feather.read_table(pa.BufferReader(self.file_bytes), columns=columns)
+        except pa.ArrowInvalid:
+            table = ipc.open_stream(pa.BufferReader(self.file_bytes)).read_all()
+            return table.select(columns) if columns is not None else table
+    
+    def _arrow_batches(self, columns, batch_size):
+        if self.format == 'parquet':
+            return pq.ParquetFile(pa.BufferReader(self.file_bytes)).iter_batches(
+                batch_size=batch_size, columns=columns
+            )
+        return self.read_table(columns).to_batches(max_chunksize=batch_size)
+    
+    @property
+    def columns(self):
+        """Column names, read from the header row (or schema) only"""
+        if self._columns is None:
+            if self.is_arrow:
+                self._columns = list(self._arrow_schema().names)
+            else:
+                self._columns = self._read(nrows=0).columns.tolist()
+        return self._columns
+    
+    def header_frame(self):
+        """Empty frame carrying the header, enough for map_data_to_template"""
+        return pd.DataFrame(columns=self.columns)
+    
+    def preview(self, rows=5):
+        if self.is_arrow:
+            for batch in self._arrow_batches(None, rows):
+                return batch.to_pandas().head(rows)
+            return self.header_frame()
+        return self._read(nrows=rows)
+    
+    def project(self, columns):
+        """Requested columns that exist in the file, in file order"""
+        wanted = set(columns)
+        return [col for col in self.columns if col in wanted]
+    
+    def load(self, columns=None):
+        """Load all rows, projected to the given columns (all columns if None)"""
+        if columns is not None:
+            columns = self.project(columns)
+            if not columns:
+                return self.header_frame()
+        if self.is_arrow:
+            return self.read_table(columns).to_pandas()
+        if columns is None:
+            return self._read()
+        # A callable selects by name; a list would treat numeric headers (e.g. years) as positions
+        wanted = set(columns)
+        return self._read(usecols=lambda column: column in wanted)
+    
+    def row_count(self, frame=None):
+        if frame is not None:
+            return len(frame)
+        if self._row_count is None:
+            if self.format == 'parquet':
+                self._row_count = pq.ParquetFile(pa.BufferReader(self.file_bytes)).metadata.num_rows
+            elif self.is_arrow:
+                self._row_count = self.read_table().num_rows
+            else:
+                self._row_count = len(self._read(usecols=[0]))
+        return self._row_count
+    
+    def records(self, columns, batch_size=1024, frame=None):
+        """Yield one dict (column -> value) per row, limited to the given columns
+        
+        Arrow sources stream record batches; CSV/Excel iterate frame (an already
+        loaded projection) or load the projection first.
+        """
+        columns = self.project(columns)
+        if self.is_arrow:
+            if not columns:
+                for _ in range(self.row_count()):
+                    yield {}
+                return
+            for batch in self._arrow_batches(columns, batch_size):
+                values = batch.to_pydict()
+                names = list(values)
+                for row in zip(*(values[name] for name in names)):
+                    yield dict(zip(names, row))
+            return
+        if frame is None:
+            frame = self.load(columns)
+        names = [col for col in columns if col in frame.columns]
+        for row in frame[names].itertuples(index=False, name=None):
+            yield dict(zip(names, row))
+    
+    def record_at(self, index, columns, frame=None):
+        """One row as records() would yield it
+        
+        frame is an already loaded projection: a DataFrame, or an Arrow table for
+        Arrow sources.
+        """
+        columns = self.project(columns)
+        if self.is_arrow:
+            table = frame if frame is not None else self.read_table(columns)
+            names = [col for col in columns if col in table.column_names]
+            return table.select(names).slice(index, 1).to_pylist()[0]
+        if frame is None:
+            frame = self.load(columns)
+        # Column-wise access keeps each column's dtype (a row Series would upcast)
+        return {col: frame[col].iat[index] for col in columns if col in frame.columns}
+
+def mapped_data_columns(mapping_results):
+    """Distinct data columns used by a mapping, in first-use order"""
+    columns = []
+    for mapping in mapping_results.values():
+        if mapping.get('is_mappable') and mapping.get('data_column') is not None:
+            if mapping['data_column'] not in columns:
+                columns.append(mapping['data_column'])
+    return columns
+
+def prepare_fill(mapper, file_data, template_fields, fill_plan, source, cancelled=None):
+    """Everything before the final write of a single fill: mapping, column load, first record, target cells
+    
+    Returns a dict with 'mapper', 'mapping_results', 'data_columns', 'data_df' (None
+    for Arrow sources), 'record', 'workbook' and 'targets', or None if cancelled
+    (a threading.Event) was set between steps. If a step fails, the error is
+    recorded in mapper.diagnostics and 'workbook' is None.
+    """
+    def is_cancelled():
+        return cancelled is not None and cancelled.is_set()
+    
+    try:
+        mapping_results = mapper.map_data_to_template(template_fields, source.header_frame(), remember=False)
+        if is_cancelled():
+            return None
+        
+        data_columns = mapped_data_columns(mapping_results)
+        data_df = None if source.is_arrow else source.load(data_columns)
+        record = next(source.records(data_columns, frame=data_df), None)
+        if is_cancelled():
+            return None
+        
+        workbook = openpyxl.load_workbook(io.BytesIO(file_data))
+        targets = mapper.resolve_fill_targets(workbook.active, mapping_results, fill_plan)
+        if is_cancelled():
+            return None
+    except Exception as e:
+        mapper.diagnostics.error('prepare_fill', f"Error preparing fill: {e}")
+        return failed_fill(mapper)
+    
+    return {
+        'mapper': mapper,
+        'mapping_results': mapping_results,
+        'data_columns': data_columns,
+        'data_df': data_df,
+        'record': record,
+        'workbook': workbook,
+        'targets': targets
+    }
+
+def failed_fill(mapper):
+    """prepare_fill result for a fill that could not be prepared; the reason is in mapper.diagnostics"""
+    return {
+        'mapper': mapper,
+        'mapping_results': {},
+        'data_columns': [],
+        'data_df': None,
+        'record': None,
+        'workbook': None,
+        'targets': {}
+    }
+
+class PrefetchJob:
+    """Runs prepare_fill speculatively in a background thread
+    
+    key identifies the selection the work was started for; cancel() stops it
+    at the next step boundary.
+    """
+    def __init__(self, key, *args):
+        self.key = key
+        self.cancelled = threading.Event()
+        self.consumed = False
+        self.error = None
+        self.started = time.time()
+        self.elapsed = None
+        self._result = None
+        self._thread = threading.Thread(target=self._run, args=args, daemon=True,
+                                        name=f"prefetch-{key[0]}")
+        self._thread.start()
+    
+    def _run(self, mapper, *args):
+        try:
+            result = prepare_fill(mapper, *args, cancelled=self.cancelled)
+        except Exception as e:
+            self.error = e
+            mapper.diagnostics.error('prepare_fill', f"Error preparing fill: {e}")
+            result = failed_fill(mapper)
+        if not self.cancelled.is_set():
+            self._result = result
+        self.elapsed = time.time() - self.started
+    
+    @property
+    def done(self):
+        return not self._thread.is_alive()
+    
+    def cancel(self):
+        self.cancelled.set()
+        self._result = None
+    
+    def consume(self, timeout=None):
+        """Take the prepared fill for the final write and release it from the job"""
+        result = self.result(timeout)
+        self.consumed = True
+        self._result = None
+        return result
+    
+    def result(self, timeout=None):
+        """Wait for the prepared fill; None if cancelled, already used or still running after timeout
+        
+        A failed preparation is returned as failed_fill() with the error in its
+        mapper's diagnostics, so it is reported rather than repeated.
+        """
+        self._thread.join(timeout)
+        if self._thread.is_alive() or self.cancelled.is_set() or self.consumed:
+            return None
+        return self._result
+
+class FillPreview:
+    """HTML grid of a template's used range showing the values a record would be filled into
+    
+    Built once from the analyzed fields, used range, merged ranges, mapping results
+    and resolved target cells; render() only substitutes one record's values, so
+    no workbook is opened.
+    """
+    MAX_ROWS = 200
+    MAX_COLS = 40
+    STYLE = (
+        "<style>"
+        ".fill-preview{border-collapse:collapse;font-size:12px;font-family:Calibri,Arial,sans-serif}"
+        ".fill-preview td,.fill-preview th{border:1px solid #d0d7de;padding:2px 6px;white-space:nowrap;"
+        "max-width:260px;overflow:hidden;text-overflow:ellipsis}"
+        ".fill-preview th{background:#f0f2f6;color:#57606a;font-weight:normal;text-align:center}"
+        ".fill-preview td.label{font-weight:600}"
+        ".fill-preview td.value{background:#dafbe1;color:#116329}"
+        ".fill-preview td.empty{background:#fff8c5;color:#9a6700;font-style:italic}"
+        "</style>"
+    )
+    
+    def __init__(self, fields, used_range, merged_ranges, mapping_results, targets):
+        self.labels = {(field['row'], field['column']): field['value'] for field in fields.values()}
+        
+        # Merged ranges: anchor -> (rowspan, colspan); every other covered cell -> its anchor
+        self.spans = {}
+        self.covered = {}
+        for merged_range in merged_ranges:
+            min_col, min_row, max_col, max_row = range_boundaries(str(merged_range))
+            self.spans[(min_row, min_col)] = (max_row - min_row + 1, max_col - min_col + 1)
+            for row in range(min_row, max_row + 1):
+                for col in range(min_col, max_col + 1):
+                    if (row, col) != (min_row, min_col):
+                        self.covered[(row, col)] = (min_row, min_col)
+        
+        # Target cell -> data column; values landing on a merged cell go to its anchor
+        self.slots = {}
+        for coord, target in targets.items():
+            mapping = mapping_results.get(coord)
+            if not target or not mapping or mapping.get('data_column') is None:
+                continue
+            min_col, min_row, _, _ = range_boundaries(target)
+            position = self.covered.get((min_row, min_col), (min_row, min_col))
+            self.slots[position] = (mapping['data_column'], mapping['template_field'])
+        
+        positions = list(self.labels) + list(self.slots)
+        if used_range and used_range.get('ref'):
+            positions += [(used_range['min_row'], used_range['min_col']),
+                          (used_range['max_row'], used_range['max_col'])]
+        rows = [row for row, _ in positions] or [1]
+        cols = [col for _, col in positions] or [1]
+        self.min_row, self.min_col = min(rows), min(cols)
+        self.max_row = min(max(rows), self.min_row + self.MAX_ROWS - 1)
+        self.max_col = min(max(cols), self.min_col + self.MAX_COLS - 1)
+        self.truncated = max(rows) > self.max_row or max(cols) > self.max_col
+        self.column_header = ''.join(f"<th>{get_column_letter(col)}</th>"
+                                     for col in range(self.min_col, self.max_col + 1))
+    
+    def to_bytes(self):
+        """Binary form: the grid state, which holds only built-in types, pickled"""
+        return pickle.dumps(self.__dict__, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    @classmethod
+    def from_bytes(cls, data):
+        preview = cls.__new__(cls)
+        preview.__dict__.update(pickle.loads(data))
+        return preview
+    
+    def __reduce__(self):
+        return (self.from_bytes, (self.to_bytes(),))
+    
+    def render(self, record):
+        """HTML table for one record (None shows the mapped column names instead of values)"""
+        parts = [self.STYLE, '<table class="fill-preview"><tr><th></th>', self.column_header, '</tr>']
+        for row in range(self.min_row, self.max_row + 1):
+            parts.append(f"<tr><th>{row}</th>")
+            for col in range(self.min_col, self.max_col + 1):
+                position = (row, col)
+                if position in self.covered:
+                    anchor = self.covered[position]
+                    # Cells hidden under a merge drawn in this grid emit nothing
+                    if anchor[0] >= self.min_row and anchor[1] >= self.min_col:
+                        continue
+                span = ''
+                if position in self.spans:
+                    rowspan, colspan = self.spans[position]
+                    rowspan = min(rowspan, self.max_row - row + 1)
+                    colspan = min(colspan, self.max_col - col + 1)
+                    span = f' rowspan="{rowspan}" colspan="{colspan}"'
+                
+                if position in self.slots:
+                    column, label = self.slots[position]
+                    title = html.escape(f"{label} ← {column}", quote=True)
+                    if record is None:
+                        parts.append(f'<td class="empty"{span} title="{title}">{{{html.escape(str(column))}}}</td>')
+                    else:
+                        text = html.escape(AdvancedTemplateMapper.format_cell_value(record.get(column)))
+                        parts.append(f'<td class="value"{span} title="{title}">{text}</td>')
+                elif position in self.labels:
+                    parts.append(f'<td class="label"{span}>{html.escape(self.labels[position])}</td>')
+                else:
+                    parts.append(f"<td{span}></td>")
+            parts.append("</tr>")
+        parts.append("</table>")
+        return ''.join(parts)
+
+# Process-wide admission limits for batch jobs
+MAX_CONCURRENT_BATCH_JOBS = int(os.environ.get('MAX_CONCURRENT_BATCH_JOBS', '2'))
+BATCH_MEMORY_CEILING_MB = float(os.environ.get('BATCH_MEMORY_CEILING_MB', '2048'))
+BATCH_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('BATCH_QUEUE_TIMEOUT_SECONDS', '120'))
+
+class ResourceLimitExceeded(Exception):
+    """Raised when a batch job cannot be admitted within the configured limits"""
+
+class ResourceGovernor:
+    """Limits concurrent batch jobs and measures their memory and CPU usage
+    
+    Jobs wait in a queue while the concurrency limit is reached or the process
+    RSS plus the job's estimate would exceed the memory ceiling. The part of a
+    running job's estimate it has not allocated yet stays reserved, so jobs
+    started back to back cannot all slip in under the same RSS reading. They are
+    rejected when admission does not happen within the queue timeout. Memory
+    figures are process-wide (all sessions share one process), CPU time is
+    measured per job thread.
+    """
+    POLL_SECONDS = 0.5
+    
+    def __init__(self, max_jobs, memory_ceiling_bytes, queue_timeout):
+        self.max_jobs = max_jobs
+        self.memory_ceiling_bytes = memory_ceiling_bytes
+        self.queue_timeout = queue_timeout
+        self.active_jobs = {}
+        self.completed_jobs = deque(maxlen=20)
+        self.waiting = 0
+        self.rejected = 0
+        self._next_id = 1
+        self._condition = threading.Condition()
+        self._process = psutil.Process() if PSUTIL_AVAILABLE else None
+    
+    def rss(self):
+        return self._process.memory_info().rss if self._process else 0
+    
+    def cpu_percent(self):
+        return self._process.cpu_percent(interval=None) if self._process else 0.0
+    
+    def _can_admit(self, estimated_bytes):
+        if len(self.active_jobs) >= self.max_jobs:
+            return False
+        rss = self.rss()
+        reserved = sum(max(job['estimated_bytes'] - (rss - job['start_rss']), 0)
+                       for job in self.active_jobs.values())
+        return rss + reserved + estimated_bytes <= self.memory_ceiling_bytes
+    
+    @contextmanager
+    def admit(self, name, user, estimated_bytes=0):
+        """Run a job inside the limits; raises ResourceLimitExceeded if it cannot be admitted"""
+        deadline = time.monotonic() + self.queue_timeout
+        with self._condition:
+            if estimated_bytes > self.memory_ceiling_bytes:
+                self.rejected += 1
+                raise ResourceLimitExceeded(
+                    f"Job needs about {estimated_bytes / 1024 / 1024:.0f} MB, "
+                    f"above the {self.memory_ceiling_bytes / 1024 / 1024:.0f} MB ceiling"
+                )
+            self.waiting += 1
+            try:
+                while not self._can_admit(estimated_bytes):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise ResourceLimitExceeded(
+                            f"No batch slot available after {self.queue_timeout:.0f}s "
+                            f"({len(self.active_jobs)} running, {self.waiting - 1} queued)"
+                        )
+                    # Poll as well as wait: RSS can drop without a job finishing
+                    self._condition.wait(min(remaining, self.POLL_SECONDS))
+            finally:
+                self.waiting -= 1
+            
+            job_id = self._next_id
+            self._next_id += 1
+            rss = self.rss()
+            job = {
+                'id': job_id,
+                'name': name,
+                'user': user,
+                'started': datetime.now().strftime("%H:%M:%S"),
+                'estimated_mb': estimated_bytes / 1024 / 1024,
+                'estimated_bytes': estimated_bytes,
+                'start_rss': rss,
+                'peak_rss': rss,
+                'start_wall': time.monotonic(),
+                'start_cpu': time.thread_time(),
+                'progress': 0
+            }
+            self.active_jobs[job_id] = job
+        
+        try:
+            yield job
+        finally:
+            self.checkpoint(job)
+            with self._condition:
+                self.active_jobs.pop(job_id, None)
+                self.completed_jobs.appendleft(self.job_summary(job))
+                self._condition.notify_all()
+    
+    def checkpoint(self, job, progress=None):
+        """Record a job's progress and current resource usage (call from the job thread)"""
+        job['peak_rss'] = max(job['peak_rss'], self.rss())
+        job['cpu_seconds'] = time.thread_time() - job['start_cpu']
+        if progress is not None:
+            job['progress'] = progress
+    
+    @staticmethod
+    def job_summary(job):
+        return {
+            'job': job['id'],
+            'name': job['name'],
+            'user': job['user'],
+            'started': job['started'],
+            'progress': job['progress'],
+            'elapsed_s': round(time.monotonic() - job['start_wall'], 1),
+            'cpu_s': round(job.get('cpu_seconds', 0.0), 1),
+            'rss_delta_mb': round((job['peak_rss'] - job['start_rss']) / 1024 / 1024, 1),
+            'estimated_mb': round(job['estimated_mb'], 1)
+        }
+    
+    def status(self):
+        with self._condition:
+            return {
+                'rss_mb': self.rss() / 1024 / 1024,
+                'ceiling_mb': self.memory_ceiling_bytes / 1024 / 1024,
+                'cpu_percent': self.cpu_percent(),
+                'active': [self.job_summary(job) for job in self.active_jobs.values()],
+                'queued': self.waiting,
+                'max_jobs': self.max_jobs,
+                'rejected': self.rejected,
+                'completed': list(self.completed_jobs)
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_resource_governor():
+    """Process-wide ResourceGovernor shared by all sessions"""
+    return ResourceGovernor(MAX_CONCURRENT_BATCH_JOBS, int(BATCH_MEMORY_CEILING_MB * 1024 * 1024),
+                            BATCH_QUEUE_TIMEOUT_SECONDS)
+
+# Per-session memory budget for large objects (template bytes, field maps, data frames, results)
+SESSION_MEMORY_BUDGET_MB = float(os.environ.get('SESSION_MEMORY_BUDGET_MB', '64'))
+
+class SessionMemoryStore:
+    """Memory-budgeted key/value store that spills least recently used objects to disk"""
+    def __init__(self, budget_bytes, spill_dir=None):
+        self.budget_bytes = budget_bytes
+        self.spill_dir = spill_dir or tempfile.mkdtemp(prefix='template_mapper_')
+        self._resident = OrderedDict()  # key -> (obj, size), oldest first
+        self._spilled = {}  # key -> (path, size, codec)
+        self._unspillable = set()  # keys whose current object failed to pickle
+        self.evictions = 0
+        self.rehydrations = 0
+        # Remove spilled files once the session (and this store) goes away
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+    
+    @staticmethod
+    def estimate_size(obj):
+        """Estimate the in-memory size of an object in bytes"""
+        try:
+            if isinstance(obj, (bytes, bytearray)):
+                return len(obj)
+            if isinstance(obj, pd.DataFrame):
+                return int(obj.memory_usage(deep=True).sum())
+            if isinstance(obj, io.BytesIO):
+                return obj.getbuffer().nbytes
+            if hasattr(obj, 'to_bytes'):
+                return len(obj.to_bytes())
+            if ARROW_AVAILABLE and isinstance(obj, pa.Table):
+                return obj.nbytes
+            return len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            print(f"Warning: Could not measure {type(obj).__name__}, using a rough estimate: {e}")
+            return SessionMemoryStore.rough_size(obj)
+    
+    @staticmethod
+    def rough_size(obj, depth=0):
+        """Recursive sys.getsizeof over containers and instance attributes"""
+        rough_size = SessionMemoryStore.rough_size
+        size = sys.getsizeof(obj)
+        if depth > 8:
+            return size
+        if isinstance(obj, dict):
+            size += sum(rough_size(key, depth + 1) + rough_size(value, depth + 1) for key, value in obj.items())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            size += sum(rough_size(item, depth + 1) for item in obj)
+        elif hasattr(obj, '__dict__'):
+            size += rough_size(vars(obj), depth + 1)
+        return size
+    
+    @property
+    def resident_bytes(self):
+        return sum(size for _, size in self._resident.values())
+    
+    @property
+    def spilled_bytes(self):
+        return sum(size for _, size, _ in self._spilled.values())
+    
+    def __contains__(self, key):
+        return key in self._resident or key in self._spilled
+    
+    def put(self, key, obj):
+        """Store an object, evicting older entries to disk if the budget is exceeded"""
+        self.delete(key)
+        self._resident[key] = (obj, self.estimate_size(obj))
+        self._enforce_budget()
+    
+    def get(self, key, default=None):
+        """Return an object, rehydrating it from disk if it was spilled"""
+        if key in self._resident:
+            self._resident.move_to_end(key)
+            return self._resident[key][0]
+        if key in self._spilled:
+            path, _, codec = self._spilled.pop(key)
+            try:
+                with open(path, 'rb') as spill_file:
+                    if codec:
+                        obj = globals()[codec].from_bytes(spill_file.read())
+                    else:
+                        obj = pickle.load(spill_file)
+                os.unlink(path)
+            except Exception as e:
+                print(f"Warning: Could not rehydrate {key}: {e}")
+                return default
+            self.rehydrations += 1
+            self.put(key, obj)
+            return obj
+        return default
+    
+    def delete(self, key):
+        self._resident.pop(key, None)
+        self._unspillable.discard(key)
+        spilled = self._spilled.pop(key, None)
+        if spilled:
+            try:
+                os.unlink(spilled[0])
+            except OSError:
+                pass
+    
+    def delete_prefix(self, prefix):
+        for key in [k for k in list(self._resident) + list(self._spilled) if k.startswith(prefix)]:
+            self.delete(key)
+    
+    def _enforce_budget(self):
+        # Oldest first; always keep the most recently used object in memory
+        for key in list(self._resident)[:-1]:
+            if self.resident_bytes <= self.budget_bytes:
+                break
+            if key in self._unspillable:
+                continue
+            obj, size = self._resident[key]
+            path = os.path.join(self.spill_dir, hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+            # Objects with a binary form (to_bytes/from_bytes) are written as that form.
+            # Pickle refers to classes by name, and the script's classes are redefined
+            # on every rerun, so instances from an earlier run cannot be pickled
+            codec = type(obj).__name__ if hasattr(obj, 'to_bytes') else None
+            try:
+                with open(path, 'wb') as spill_file:
+                    if codec:
+                        spill_file.write(obj.to_bytes())
+                    else:
+                        pickle.dump(obj, spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                # Keep the object if it cannot be written out and try the next one
+                print(f"Warning: Could not spill {key} to disk: {e}")
+                self._unspillable.add(key)
+                if os.path.exists(path):
+                    os.unlink(path)
+                continue
+            del self._resident[key]
+            self._spilled[key] = (path, size, codec)
+            self.evictions += 1
+    
+    def usage(self):
+        """Summary of current memory usage"""
+        return {
+            'budget_bytes': self.budget_bytes,
+            'resident_bytes': self.resident_bytes,
+            'spilled_bytes': self.spilled_bytes,
+            'resident_items': len(self._resident),
+            'spilled_items': len(self._spilled),
+            'evictions': self.evictions,
+            'rehydrations': self.rehydrations
+        }
 
 # Initialize session state
 if 'authenticated' not in st.session_state:
@@ -606,6 +2205,195 @@ if 'templates' not in st.session_state:
     st.session_state.templates = {}
 if 'ai_mapper' not in st.session_state:
     st.session_state.ai_mapper = AdvancedTemplateMapper()
+if 'memory_store' not in st.session_state:
+    st.session_state.memory_store = SessionMemoryStore(int(SESSION_MEMORY_BUDGET_MB * 1024 * 1024))
+if 'last_result' not in st.session_state:
+    st.session_state.last_result = None
+if 'fanout_result' not in st.session_state:
+    st.session_state.fanout_result = None
+if 'prefetch' not in st.session_state:
+    st.session_state.prefetch = None
+if 'mapping_memory' not in st.session_state:
+    st.session_state.mapping_memory = MappingMemory(MAPPING_MEMORY_PATH)
+st.session_state.ai_mapper.mapping_memory = st.session_state.mapping_memory
+
+def store_template_payload(template_name, file_data, fields, fill_plan=None):
+    """Keep the large template objects in the memory-budgeted store
+    
+    Results filled from an earlier template of the same name are dropped.
+    """
+    store = st.session_state.memory_store
+    clear_template_results(template_name)
+    store.put(f"template/{template_name}/file_data", file_data)
+    store.put(f"template/{template_name}/fields", fields)
+    store.put(f"template/{template_name}/fill_plan", fill_plan)
+
+def get_template_payload(template_name, key):
+    """Fetch a large template object ('file_data', 'fields' or 'fill_plan'), rehydrating it if spilled"""
+    return st.session_state.memory_store.get(f"template/{template_name}/{key}")
+
+def clear_template_results(template_name):
+    """Drop the filled results, batch archives and previews made from a template"""
+    store = st.session_state.memory_store
+    store.delete_prefix(f"result/{template_name}/")
+    last_result = st.session_state.last_result
+    if last_result and last_result['template'] == template_name:
+        st.session_state.last_result = None
+    fanout_result = st.session_state.fanout_result
+    if fanout_result and template_name in fanout_result['templates']:
+        st.session_state.fanout_result = None
+        store.delete("result/fanout/archive")
+
+def delete_template(template_name):
+    st.session_state.templates.pop(template_name, None)
+    st.session_state.memory_store.delete_prefix(f"template/{template_name}/")
+    clear_template_results(template_name)
+
+def get_data_source(data_file):
+    """DataSource for an uploaded file
+    
+    The raw bytes are kept in the memory-budgeted store across reruns; the
+    DataSource around them is rebuilt each run, since instances of the script's
+    classes from an earlier run cannot be pickled when the store spills.
+    """
+    file_bytes = data_file.getvalue()
+    key = f"data/{hashlib.sha1(file_bytes).hexdigest()}/file"
+    store = st.session_state.memory_store
+    if key not in store:
+        store.put(key, file_bytes)
+    return DataSource(data_file.name, store.get(key))
+
+def data_columns_key(source, columns):
+    return f"data/{source.key}/columns/{hashlib.sha1(json.dumps(sorted(map(str, columns))).encode()).hexdigest()}"
+
+def load_data_columns(source, columns):
+    """Load only the given columns of a data source, parsed once per column set
+    
+    Returns None for Arrow sources, whose rows are streamed by DataSource.records.
+    """
+    if source.is_arrow:
+        return None
+    key = data_columns_key(source, columns)
+    store = st.session_state.memory_store
+    data_df = store.get(key)
+    if data_df is None:
+        data_df = source.load(columns)
+        store.put(key, data_df)
+    return data_df
+
+def load_preview_frame(source, columns):
+    """Random-access rows for the fill preview: the loaded projection, or a cached Arrow table"""
+    if not source.is_arrow:
+        return load_data_columns(source, columns)
+    key = f"{data_columns_key(source, columns)}/table"
+    store = st.session_state.memory_store
+    table = store.get(key)
+    if table is None:
+        table = source.read_table(source.project(columns))
+        store.put(key, table)
+    return table
+
+def cancel_fill_prefetch():
+    job = st.session_state.get('prefetch')
+    if job is not None:
+        job.cancel()
+        st.session_state.prefetch = None
+
+def get_fill_prefetch(template_name, source):
+    """PrefetchJob for the selected template and data file, started on first sight of the selection
+    
+    A job for any other selection (template, template upload, data file or
+    similarity threshold) is cancelled and replaced.
+    """
+    mapper = st.session_state.ai_mapper
+    key = (template_name, st.session_state.templates[template_name].get('fingerprint'),
+           st.session_state.templates[template_name].get('created_date'), source.key, mapper.similarity_threshold)
+    job = st.session_state.get('prefetch')
+    if job is not None and job.key == key:
+        return job
+    cancel_fill_prefetch()
+    job = PrefetchJob(key, mapper.worker_copy(), get_template_payload(template_name, 'file_data'),
+                      get_template_payload(template_name, 'fields'), get_template_payload(template_name, 'fill_plan'),
+                      source)
+    st.session_state.prefetch = job
+    return job
+
+def estimate_batch_bytes(template_bytes, row_count, reference_duplicates=False):
+    """Rough memory need of a batch run: an open workbook (~20x the xlsx size) plus the zip of all outputs
+    
+    Unless duplicates are referenced, each distinct output is also held for copying.
+    """
+    per_row = 1 if reference_duplicates else 2
+    return template_bytes * (20 + per_row * row_count)
+
+def build_batch_archive(mapper, fill_jobs, records, timestamp, progress=None, reference_duplicates=False):
+    """Fill every template in fill_jobs for each record, in a single pass over the data
+    
+    fill_jobs is a list of dicts with 'name', 'file_data', 'mapping_results' and
+    'fill_plan'. Rows whose mapped values are identical produce identical files, so
+    each distinct row is filled once per template and its bytes are copied for the
+    duplicates (or, with reference_duplicates, listed in duplicates.csv instead).
+    All outputs go into one zip; returns (zip bytes, per-template stats with
+    'files', 'generated' and 'deduplicated' counts).
+    """
+    import zipfile
+    
+    stats = {job['name']: {'files': 0, 'generated': 0, 'deduplicated': 0} for job in fill_jobs}
+    duplicate_rows = []
+    
+    for job in fill_jobs:
+        job['columns'] = mapped_data_columns(job['mapping_results'])
+        job['outputs'] = {}  # mapped values -> (file name, workbook bytes, or None when referencing duplicates)
+    
+    # Create zip file for multiple templates
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for idx, record in enumerate(records):
+            for job in fill_jobs:
+                row_filename = f"{job['name']}_row_{idx+1}_{timestamp}.xlsx"
+                job_stats = stats[job['name']]
+                
+                # Identical mapped values give an identical workbook
+                row_key = tuple(mapper.format_cell_value(record.get(column)) for column in job['columns'])
+                if row_key in job['outputs']:
+                    original_filename, row_bytes = job['outputs'][row_key]
+                    job_stats['deduplicated'] += 1
+                    if reference_duplicates:
+                        duplicate_rows.append((row_filename, original_filename))
+                    else:
+                        zip_file.writestr(row_filename, row_bytes)
+                        job_stats['files'] += 1
+                    continue
+                
+                # Fill template for this row
+                row_workbook, _ = mapper.fill_template_with_record(
+                    io.BytesIO(job['file_data']), job['mapping_results'], record, fill_plan=job['fill_plan']
+                )
+                
+                if row_workbook:
+                    output = io.BytesIO()
+                    row_workbook.save(output)
+                    row_bytes = output.getvalue()
+                    # Duplicates only need the bytes when they are copied
+                    job['outputs'][row_key] = (row_filename, None if reference_duplicates else row_bytes)
+                    zip_file.writestr(row_filename, row_bytes)
+                    job_stats['files'] += 1
+                    job_stats['generated'] += 1
+            
+            if progress:
+                progress(idx + 1)
+        
+        if duplicate_rows:
+            manifest = io.StringIO()
+            manifest.write("file,same_as\n")
+            for row_filename, original_filename in duplicate_rows:
+                manifest.write(f"{row_filename},{original_filename}\n")
+            zip_file.writestr("duplicates.csv", manifest.getvalue())
+    
+    for job in fill_jobs:
+        del job['outputs']
+    
+    return zip_buffer.getvalue(), stats
 
 # User management functions
 def hash_password(password):
@@ -688,6 +2476,10 @@ def show_dashboard():
                 ["Dashboard", "AI Data Processor", "View Templates"]
             )
     
+    # A prepared fill holds an open workbook and data outside the memory budget
+    if page != "AI Data Processor":
+        cancel_fill_prefetch()
+    
     # Page routing
     if page == "Dashboard":
         show_dashboard_content()
@@ -700,6 +2492,29 @@ def show_dashboard():
     elif page == "AI Data Processor":
         show_data_processor()
 
+def show_diagnostics(diagnostics_rows):
+    """Render aggregated engine diagnostics as a single summary table"""
+    if not diagnostics_rows:
+        return
+    
+    error_count = sum(row['count'] for row in diagnostics_rows if row['level'] == 'error')
+    warning_count = sum(row['count'] for row in diagnostics_rows if row['level'] == 'warning')
+    
+    with st.expander(f"⚠️ Diagnostics: {error_count} errors, {warning_count} warnings", expanded=error_count > 0):
+        st.dataframe(pd.DataFrame(diagnostics_rows), use_container_width=True, hide_index=True)
+
+def show_used_range(used_range):
+    """Report the content bounds the analysis was limited to"""
+    if not used_range or not used_range['ref']:
+        return
+    used_rows = used_range['max_row'] - used_range['min_row'] + 1
+    used_cols = used_range['max_col'] - used_range['min_col'] + 1
+    message = f"📐 Used range {used_range['ref']} ({used_rows} × {used_cols})"
+    if used_range['skipped_cells']:
+        message += (f", trimmed from a {used_range['sheet_rows']:,} × {used_range['sheet_cols']:,} sheet "
+                    f"({used_range['skipped_cells']:,} empty cells skipped)")
+    st.caption(message)
+
 def show_dashboard_content():
     st.header("🚀 Enhanced AI Template System")
     
@@ -723,6 +2538,31 @@ def show_dashboard_content():
         st.metric("Available Templates", total_templates)
         st.metric("AI Similarity Threshold", f"{threshold:.2f}")
         st.metric("Advanced Processing", "Active" if ADVANCED_NLP else "Basic")
+    
+    if st.session_state.user_role == 'admin':
+        show_resource_monitor()
+
+@st.fragment(run_every=2)
+def show_resource_monitor():
+    """Live process resource usage and batch queue (admin only)"""
+    st.subheader("🖥️ Resource Monitor")
+    status = get_resource_governor().status()
+    
+    if not PSUTIL_AVAILABLE:
+        st.warning("Install psutil to see memory and CPU usage")
+    
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Process Memory", f"{status['rss_mb']:.0f} MB", help=f"Ceiling: {status['ceiling_mb']:.0f} MB")
+    col2.metric("CPU", f"{status['cpu_percent']:.0f}%")
+    col3.metric("Running Jobs", f"{len(status['active'])} / {status['max_jobs']}")
+    col4.metric("Queued Jobs", status['queued'], help=f"Rejected so far: {status['rejected']}")
+    
+    if status['active']:
+        st.write("**Running:**")
+        st.dataframe(pd.DataFrame(status['active']), use_container_width=True, hide_index=True)
+    if status['completed']:
+        st.write("**Recently completed:**")
+        st.dataframe(pd.DataFrame(status['completed']), use_container_width=True, hide_index=True)
 
 def show_upload_template():
     if st.session_state.user_role != 'admin':
@@ -745,18 +2585,23 @@ def show_upload_template():
                         tmp_file.write(uploaded_file.getvalue())
                         tmp_path = tmp_file.name
                     
-                    # Analyze template
-                    template_fields = st.session_state.ai_mapper.find_template_fields(tmp_path)
+                    # Analyze template (reuses cached analysis for structurally identical forms)
+                    st.session_state.ai_mapper.diagnostics.clear()
+                    analysis = st.session_state.ai_mapper.analyze_template(tmp_path)
+                    template_fields = analysis['fields']
                     
                     # Determine template type
                     template_type = "Complex Form" if len(template_fields) > 10 else "Standard"
                     
-                    # Store template data
+                    # Store template data; large objects go to the memory-budgeted store
+                    store_template_payload(template_name, uploaded_file.getvalue(), template_fields,
+                                           analysis['fill_plan'])
                     st.session_state.templates[template_name] = {
-                        'file_data': uploaded_file.getvalue(),
-                        'fields': template_fields,
                         'field_count': len(template_fields),
                         'type': template_type,
+                        'fingerprint': analysis['fingerprint'],
+                        'used_range': analysis['used_range'],
+                        'merged_ranges': analysis['merged_ranges'],
                         'created_date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                         'created_by': st.session_state.username
                     }
@@ -766,6 +2611,11 @@ def show_upload_template():
                     
                     st.success(f"Template '{template_name}' uploaded successfully!")
                     st.info(f"Detected {len(template_fields)} fields | Type: {template_type}")
+                    show_used_range(analysis['used_range'])
+                    if analysis['reused_cells']:
+                        st.info(f"♻️ Matched a known form layout: reused {analysis['reused_cells']} cells, "
+                                f"re-analyzed {analysis['reanalyzed_cells']}")
+                    show_diagnostics(st.session_state.ai_mapper.diagnostics.summary())
                     
                     # Show field breakdown
                     field_types = {}
@@ -787,7 +2637,7 @@ def show_templates():
         st.info("No templates available")
         return
     
-    for template_name, template_info in st.session_state.templates.items():
+    for template_name, template_info in list(st.session_state.templates.items()):
         with st.expander(f"📋 {template_name}"):
             col1, col2 = st.columns(2)
             
@@ -801,7 +2651,7 @@ def show_templates():
                 
                 if st.session_state.user_role == 'admin':
                     if st.button(f"Delete {template_name}", key=f"del_{template_name}"):
-                        del st.session_state.templates[template_name]
+                        delete_template(template_name)
                         st.rerun()
 
 def show_analyze_template():
@@ -820,10 +2670,14 @@ def show_analyze_template():
                     tmp_file.write(uploaded_file.getvalue())
                     tmp_path = tmp_file.name
                 
-                template_fields = st.session_state.ai_mapper.find_template_fields(tmp_path)
+                st.session_state.ai_mapper.diagnostics.clear()
+                analysis = st.session_state.ai_mapper.analyze_template(tmp_path)
+                template_fields = analysis['fields']
                 os.unlink(tmp_path)
             
             st.success(f"Analysis complete! Found {len(template_fields)} fields")
+            show_used_range(analysis['used_range'])
+            show_diagnostics(st.session_state.ai_mapper.diagnostics.summary())
             
             # Field breakdown
             field_types = {}
@@ -840,6 +2694,8 @@ def show_analyze_template():
                         st.write(f"• **{field['value']}** (Row {field['row']}, Col {field['column']})")
                         if field.get('merged_range'):
                             st.write(f"  └─ Merged range: {field['merged_range']}")
+                        if field.get('section'):
+                            st.write(f"  └─ Section: {field['section'].replace('_', ' ').title()}")
                     
                     if len(fields) > 10:
                         st.write(f"... and {len(fields) - 10} more")
@@ -852,163 +2708,374 @@ def show_data_processor():
     st.info("Upload your data file and select a template. AI will automatically map and fill the template!")
     
     # Data file upload
-    data_file = st.file_uploader("Upload Data File", type=['csv', 'xlsx'])
+    data_file = st.file_uploader("Upload Data File", type=DataSource.supported_types())
     
     # Template selection
     if st.session_state.templates:
+        fan_out = st.toggle("🔀 Fill several templates from this data file",
+                            help="Map the data against each selected template and fill them all in one pass")
+        if fan_out:
+            selected_templates = st.multiselect(
+                "Select Templates",
+                options=list(st.session_state.templates.keys())
+            )
+            cancel_fill_prefetch()
+            if data_file and selected_templates:
+                show_fanout_processor(data_file, selected_templates)
+            return
+        
+        templates = st.session_state.templates
         selected_template = st.selectbox(
             "Select Template",
-            options=list(st.session_state.templates.keys()),
-            format_func=lambda x: f"{x} ({st.session_state.templates[x]['type']})"
+            options=list(templates.keys()),
+            format_func=lambda x: f"{x} ({templates[x]['type']})"
         )
     else:
         st.warning("No templates available. Please upload a template first.")
         return
     
+    if not (data_file and selected_template):
+        cancel_fill_prefetch()
+    
     if data_file and selected_template:
         try:
-            # Load data
-            if data_file.name.lower().endswith('.csv'):
-                data_df = pd.read_csv(data_file)
-            else:
-                data_df = pd.read_excel(data_file)
+            # Phase 1: read only the header (and a few preview rows)
+            source = get_data_source(data_file)
+            data_key = source.key
+            store = st.session_state.memory_store
+            
+            # Start mapping and fill preparation while the user looks at the preview
+            prefetch = get_fill_prefetch(selected_template, source)
             
             st.subheader("📊 Data Preview")
-            st.dataframe(data_df.head(), use_container_width=True)
+            st.dataframe(source.preview(), use_container_width=True)
+            
+            prefetched = prefetch.result() if prefetch.done else None
+            if prefetched is not None and prefetched['workbook'] is not None:
+                st.caption(f"⚡ Mapping prepared in the background ({prefetch.elapsed:.2f}s)")
+            elif prefetched is not None:
+                st.caption("⚠️ Background preparation failed; process to see the diagnostics")
+            elif not prefetch.done:
+                st.caption("⏳ Preparing mapping in the background...")
             
             if st.button("🚀 Process with AI", type="primary"):
                 with st.spinner("🤖 AI is processing your data..."):
-                    # Get template info
-                    template_info = st.session_state.templates[selected_template]
-                    template_fields = template_info['fields']
-                    
-                    # Create temporary template file
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp_file:
-                        tmp_file.write(template_info['file_data'])
-                        template_path = tmp_file.name
-                    
-                    # AI mapping
-                    mapping_results = st.session_state.ai_mapper.map_data_to_template(template_fields, data_df)
+                    prepared = prefetch.consume()
+                    if prepared is None:
+                        # Not prefetched (already used): prepare now
+                        prepared = prepare_fill(
+                            st.session_state.ai_mapper.worker_copy(),
+                            get_template_payload(selected_template, 'file_data'),
+                            get_template_payload(selected_template, 'fields'),
+                            get_template_payload(selected_template, 'fill_plan'),
+                            source
+                        )
                     
-                    # Fill template
-                    filled_workbook, filled_count = st.session_state.ai_mapper.fill_template_with_data(
-                        template_path, mapping_results, data_df
-                    )
-                    
-                    # Clean up temp file
-                    os.unlink(template_path)
+                    mapper = prepared['mapper']
+                    mapping_results = prepared['mapping_results']
+                    data_columns = prepared['data_columns']
+                    filled_workbook = prepared['workbook']
+                    if filled_workbook is not None:
+                        if prepared['data_df'] is not None:
+                            store.put(data_columns_key(source, data_columns), prepared['data_df'])
+                        
+                        # Final write: fill the prepared workbook
+                        filled_count = mapper.write_record(filled_workbook.active, mapping_results,
+                                                           prepared['record'], prepared['targets'])
+                        
+                        # Persist newly accepted matches
+                        mapper.remember_matches(mapping_results)
+                        st.session_state.mapping_memory.save()
                 
                 if filled_workbook:
-                    st.success(f"✅ Processing complete! Filled {filled_count} fields automatically.")
-                    
-                    # Show mapping results
-                    st.subheader("🎯 AI Mapping Results")
-                    
-                    mapped_fields = [m for m in mapping_results.values() if m['is_mappable']]
-                    unmapped_fields = [m for m in mapping_results.values() if not m['is_mappable']]
-                    
-                    col1, col2 = st.columns(2)
-                    
-                    with col1:
-                        st.metric("Successfully Mapped", len(mapped_fields))
-                        if mapped_fields:
-                            st.write("**Mapped Fields:**")
-                            for mapping in mapped_fields[:5]:  # Show first 5
-                                confidence = mapping['similarity'] * 100
-                                st.write(f"• {mapping['template_field']} ← {mapping['data_column']} ({confidence:.1f}%)")
-                            if len(mapped_fields) > 5:
-                                st.write(f"... and {len(mapped_fields) - 5} more")
-                    
-                    with col2:
-                        st.metric("Unmapped Fields", len(unmapped_fields))
-                        if unmapped_fields:
-                            st.write("**Unmapped Fields:**")
-                            for mapping in unmapped_fields[:5]:  # Show first 5
-                                st.write(f"• {mapping['template_field']}")
-                            if len(unmapped_fields) > 5:
-                                st.write(f"... and {len(unmapped_fields) - 5} more")
-                    
-                    # Download filled template
-                    st.subheader("📥 Download Results")
-                    
-                    # Save workbook to bytes
+                    # Save workbook to bytes and keep the result across reruns
                     output = io.BytesIO()
                     filled_workbook.save(output)
-                    output.seek(0)
-                    
-                    # Generate filename
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    filename = f"{selected_template}_filled_{timestamp}.xlsx"
+                    store.delete_prefix(f"result/{selected_template}/")
+                    store.put(f"result/{selected_template}/filled", output.getvalue())
+                    store.put(f"result/{selected_template}/mapping", mapping_results)
+                    store.put(f"result/{selected_template}/targets", prepared['targets'])
+                    st.session_state.last_result = {
+                        'template': selected_template,
+                        'data_key': data_key,
+                        'filled_count': filled_count,
+                        'data_columns': data_columns,
+                        'timestamp': datetime.now().strftime("%Y%m%d_%H%M%S"),
+                        'diagnostics': mapper.diagnostics.summary()
+                    }
+                else:
+                    st.session_state.last_result = None
+                    st.error("❌ Failed to process template. Please check your data and template.")
+                    show_diagnostics(mapper.diagnostics.summary())
+            
+            last_result = st.session_state.last_result
+            if (last_result and last_result['template'] == selected_template and
+                    last_result['data_key'] == data_key):
+                mapping_results = store.get(f"result/{selected_template}/mapping", {})
+                timestamp = last_result['timestamp']
+                
+                st.success(f"✅ Processing complete! Filled {last_result['filled_count']} fields automatically.")
+                st.caption(f"Loaded {len(last_result['data_columns'])} of {len(source.columns)} data columns")
+                show_diagnostics(last_result['diagnostics'])
+                
+                # Show mapping results
+                st.subheader("🎯 AI Mapping Results")
+                
+                mapped_fields = [m for m in mapping_results.values() if m['is_mappable']]
+                unmapped_fields = [m for m in mapping_results.values() if not m['is_mappable']]
+                
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    st.metric("Successfully Mapped", len(mapped_fields))
+                    memory_hits = sum(1 for m in mapped_fields if m.get('match_source') == 'memory')
+                    st.caption(f"🧠 {memory_hits} of {len(mapping_results)} fields resolved from mapping memory")
+                    if mapped_fields:
+                        st.write("**Mapped Fields:**")
+                        for mapping in mapped_fields[:5]:  # Show first 5
+                            confidence = mapping['similarity'] * 100
+                            st.write(f"• {mapping['template_field']} ← {mapping['data_column']} ({confidence:.1f}%)")
+                        if len(mapped_fields) > 5:
+                            st.write(f"... and {len(mapped_fields) - 5} more")
+                
+                with col2:
+                    st.metric("Unmapped Fields", len(unmapped_fields))
+                    if unmapped_fields:
+                        st.write("**Unmapped Fields:**")
+                        for mapping in unmapped_fields[:5]:  # Show first 5
+                            st.write(f"• {mapping['template_field']}")
+                        if len(unmapped_fields) > 5:
+                            st.write(f"... and {len(unmapped_fields) - 5} more")
+                
+                if mapped_fields and st.button("✅ Confirm Mappings", help="Remember these matches for future runs"):
+                    for mapping in mapped_fields:
+                        st.session_state.mapping_memory.record(
+                            mapping['template_field'], mapping['data_column'], mapping['similarity'], confirmed=True
+                        )
+                    st.session_state.mapping_memory.save()
+                    st.success(f"Confirmed {len(mapped_fields)} mappings")
+                
+                if st.session_state.user_role == 'admin':
+                    with st.expander("⏱️ Candidate Pruning Benchmark"):
+                        st.caption("Maps this data header with and without the column token index")
+                        if st.button("Run Benchmark"):
+                            with st.spinner("Benchmarking..."):
+                                bench = benchmark_candidate_pruning(
+                                    get_template_payload(selected_template, 'fields'), source.columns,
+                                    st.session_state.ai_mapper.similarity_threshold
+                                )
+                            col1, col2, col3 = st.columns(3)
+                            col1.metric("Speedup", f"{bench['speedup']:.1f}x")
+                            col2.metric("Comparisons", f"{bench['indexed_comparisons']:,}",
+                                        delta=f"-{bench['exhaustive_comparisons'] - bench['indexed_comparisons']:,}")
+                            col3.metric("Same Matches", f"{bench['agreement'] * 100:.0f}%")
+                            st.write(f"Exhaustive: {bench['exhaustive_seconds'] * 1000:.0f} ms | "
+                                     f"Indexed: {bench['indexed_seconds'] * 1000:.0f} ms | "
+                                     f"{bench['labels']} labels × {bench['columns']} columns")
+                
+                show_fill_preview(source, selected_template, last_result['data_columns'], mapping_results)
+                
+                # Download filled template
+                st.subheader("📥 Download Results")
+                
+                # Generate filename
+                filename = f"{selected_template}_filled_{timestamp}.xlsx"
+                
+                st.download_button(
+                    label="📁 Download Filled Template",
+                    data=store.get(f"result/{selected_template}/filled"),
+                    file_name=filename,
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    type="primary"
+                )
+                
+                # Process multiple rows option
+                data_df = load_data_columns(source, last_result['data_columns'])
+                row_count = source.row_count(frame=data_df)
+                if row_count > 1:
+                    st.subheader("🔄 Batch Processing")
+                    st.info(f"Your data has {row_count} rows. Process all rows?")
                     
-                    st.download_button(
-                        label="📁 Download Filled Template",
-                        data=output.getvalue(),
-                        file_name=filename,
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        type="primary"
+                    reference_duplicates = st.checkbox(
+                        "Reference duplicate rows instead of copying files",
+                        help="Rows with identical mapped values are filled once; duplicates are listed in duplicates.csv"
                     )
                     
-                    # Process multiple rows option
-                    if len(data_df) > 1:
-                        st.subheader("🔄 Batch Processing")
-                        st.info(f"Your data has {len(data_df)} rows. Process all rows?")
-                        
-                        if st.button("🚀 Process All Rows", type="secondary"):
+                    if st.button("🚀 Process All Rows", type="secondary"):
+                        governor = get_resource_governor()
+                        template_file_data = get_template_payload(selected_template, 'file_data')
+                        estimated_bytes = estimate_batch_bytes(len(template_file_data), row_count, reference_duplicates)
+                        st.session_state.ai_mapper.diagnostics.clear()
+                        try:
                             with st.spinner("Processing all data rows..."):
-                                # Create zip file for multiple templates
-                                zip_buffer = io.BytesIO()
-                                
-                                with tempfile.TemporaryDirectory() as temp_dir:
-                                    filled_files = []
-                                    
-                                    for idx, row in data_df.iterrows():
-                                        # Create single-row dataframe
-                                        single_row_df = pd.DataFrame([row])
-                                        
-                                        # Create temp template file
-                                        with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp_file:
-                                            tmp_file.write(template_info['file_data'])
-                                            temp_template_path = tmp_file.name
-                                        
-                                        # Fill template for this row
-                                        row_workbook, _ = st.session_state.ai_mapper.fill_template_with_data(
-                                            temp_template_path, mapping_results, single_row_df
-                                        )
-                                        
-                                        if row_workbook:
-                                            # Save to temp directory
-                                            row_filename = f"{selected_template}_row_{idx+1}_{timestamp}.xlsx"
-                                            row_filepath = os.path.join(temp_dir, row_filename)
-                                            row_workbook.save(row_filepath)
-                                            filled_files.append((row_filename, row_filepath))
-                                        
-                                        # Clean up temp template file
-                                        os.unlink(temp_template_path)
-                                    
-                                    # Create zip file
-                                    import zipfile
-                                    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                                        for filename, filepath in filled_files:
-                                            zip_file.write(filepath, filename)
-                                
-                                zip_buffer.seek(0)
-                                
-                                st.success(f"✅ Processed {len(filled_files)} templates successfully!")
-                                
-                                st.download_button(
-                                    label="📦 Download All Filled Templates (ZIP)",
-                                    data=zip_buffer.getvalue(),
-                                    file_name=f"{selected_template}_batch_{timestamp}.zip",
-                                    mime="application/zip",
-                                    type="primary"
-                                )
-                else:
-                    st.error("❌ Failed to process template. Please check your data and template.")
+                                with governor.admit(f"{selected_template} batch", st.session_state.username,
+                                                    estimated_bytes) as job:
+                                    fill_job = {
+                                        'name': selected_template,
+                                        'file_data': template_file_data,
+                                        'mapping_results': mapping_results,
+                                        'fill_plan': get_template_payload(selected_template, 'fill_plan')
+                                    }
+                                    zip_bytes, batch_stats = build_batch_archive(
+                                        st.session_state.ai_mapper, [fill_job],
+                                        source.records(last_result['data_columns'], frame=data_df), timestamp,
+                                        progress=lambda done: governor.checkpoint(job, done),
+                                        reference_duplicates=reference_duplicates
+                                    )
+                            store.put(f"result/{selected_template}/batch", zip_bytes)
+                            st.session_state.last_result['batch_stats'] = batch_stats[selected_template]
+                            st.session_state.last_result['batch_diagnostics'] = \
+                                st.session_state.ai_mapper.diagnostics.summary()
+                        except ResourceLimitExceeded as e:
+                            st.error(f"❌ Batch job not started: {e}")
+                    
+                    if f"result/{selected_template}/batch" in store:
+                        batch_stats = last_result.get('batch_stats', {})
+                        if batch_stats.get('files'):
+                            st.success(f"✅ Processed {batch_stats['files']} templates successfully!")
+                        else:
+                            st.error("❌ Failed to process any data rows. Check the diagnostics below.")
+                        show_diagnostics(last_result.get('batch_diagnostics', []))
+                        if batch_stats.get('deduplicated'):
+                            st.info(f"♻️ {batch_stats['generated']} unique rows filled; "
+                                    f"{batch_stats['deduplicated']} duplicate fills avoided")
+                        
+                        st.download_button(
+                            label="📦 Download All Filled Templates (ZIP)",
+                            data=store.get(f"result/{selected_template}/batch"),
+                            file_name=f"{selected_template}_batch_{timestamp}.zip",
+                            mime="application/zip",
+                            type="primary"
+                        )
                     
         except Exception as e:
             st.error(f"Error processing data: {str(e)}")
             st.exception(e)
 
+@st.fragment
+def show_fill_preview(source, template_name, data_columns, mapping_results):
+    """Step through data rows and show what each would fill in, without building a workbook"""
+    st.subheader("👁️ Fill Preview")
+    store = st.session_state.memory_store
+    
+    preview = store.get(f"result/{template_name}/preview")
+    if preview is None:
+        template_info = st.session_state.templates[template_name]
+        fields = get_template_payload(template_name, 'fields')
+        merged_ranges = template_info.get('merged_ranges')
+        if merged_ranges is None:
+            # Templates analyzed before merged ranges were kept: use the ones on labels
+            merged_ranges = {field['merged_range'] for field in fields.values() if field.get('merged_range')}
+        targets = store.get(f"result/{template_name}/targets")
+        if targets is None:
+            targets = get_template_payload(template_name, 'fill_plan') or {}
+        preview = FillPreview(fields, template_info.get('used_range'), merged_ranges, mapping_results, targets)
+        store.put(f"result/{template_name}/preview", preview)
+    
+    frame = load_preview_frame(source, data_columns)
+    row_count = source.row_count(frame=frame)
+    if not row_count:
+        st.markdown(preview.render(None), unsafe_allow_html=True)
+        return
+    
+    row_number = st.number_input("Data row", min_value=1, max_value=row_count, value=1, step=1,
+                                 help="Values this row would write into the template")
+    started = time.perf_counter()
+    record = source.record_at(row_number - 1, data_columns, frame=frame)
+    st.markdown(preview.render(record), unsafe_allow_html=True)
+    caption = f"Row {row_number} of {row_count:,} rendered in {(time.perf_counter() - started) * 1000:.1f} ms"
+    if preview.truncated:
+        caption += f" | showing the first {FillPreview.MAX_ROWS} rows × {FillPreview.MAX_COLS} columns"
+    st.caption(caption)
+
+def show_fanout_processor(data_file, template_names):
+    """Map one data file against several templates and fill them all in a single data pass"""
+    try:
+        source = get_data_source(data_file)
+        store = st.session_state.memory_store
+        mapper = st.session_state.ai_mapper
+        
+        st.subheader("📊 Data Preview")
+        st.dataframe(source.preview(), use_container_width=True)
+        
+        if st.button("🚀 Process All Templates", type="primary"):
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            
+            # Map the header against every template
+            mapper.diagnostics.clear()
+            header_df = source.header_frame()
+            fill_jobs = []
+            for template_name in template_names:
+                mapping_results = mapper.map_data_to_template(get_template_payload(template_name, 'fields'), header_df)
+                fill_jobs.append({
+                    'name': template_name,
+                    'file_data': get_template_payload(template_name, 'file_data'),
+                    'mapping_results': mapping_results,
+                    'fill_plan': get_template_payload(template_name, 'fill_plan')
+                })
+            st.session_state.mapping_memory.save()
+            
+            # Load the union of mapped columns once
+            data_columns = []
+            for fill_job in fill_jobs:
+                for column in mapped_data_columns(fill_job['mapping_results']):
+                    if column not in data_columns:
+                        data_columns.append(column)
+            data_df = load_data_columns(source, data_columns)
+            row_count = source.row_count(frame=data_df)
+            
+            governor = get_resource_governor()
+            estimated_bytes = sum(estimate_batch_bytes(len(fill_job['file_data']), row_count)
+                                  for fill_job in fill_jobs)
+            try:
+                with st.spinner(f"Filling {len(fill_jobs)} templates for {row_count} rows..."):
+                    with governor.admit(f"fan-out ({len(fill_jobs)} templates)", st.session_state.username,
+                                        estimated_bytes) as job:
+                        zip_bytes, batch_stats = build_batch_archive(
+                            mapper, fill_jobs, source.records(data_columns, frame=data_df), timestamp,
+                            progress=lambda done: governor.checkpoint(job, done)
+                        )
+                store.put("result/fanout/archive", zip_bytes)
+                st.session_state.fanout_result = {
+                    'templates': list(template_names),
+                    'data_key': source.key,
+                    'timestamp': timestamp,
+                    'rows': row_count,
+                    'data_columns': data_columns,
+                    'summary': [{
+                        'template': fill_job['name'],
+                        'mapped_fields': sum(1 for m in fill_job['mapping_results'].values() if m['is_mappable']),
+                        'files': batch_stats[fill_job['name']]['files'],
+                        'generated': batch_stats[fill_job['name']]['generated'],
+                        'duplicate_fills_avoided': batch_stats[fill_job['name']]['deduplicated']
+                    } for fill_job in fill_jobs],
+                    'diagnostics': mapper.diagnostics.summary()
+                }
+            except ResourceLimitExceeded as e:
+                st.error(f"❌ Batch job not started: {e}")
+        
+        result = st.session_state.fanout_result
+        if (result and result['data_key'] == source.key and result['templates'] == list(template_names)
+                and "result/fanout/archive" in store):
+            total_files = sum(row['files'] for row in result['summary'])
+            st.success(f"✅ Filled {total_files} files from {result['rows']} rows across "
+                       f"{len(result['templates'])} templates in one pass")
+            st.caption(f"Loaded {len(result['data_columns'])} of {len(source.columns)} data columns")
+            show_diagnostics(result['diagnostics'])
+            st.dataframe(pd.DataFrame(result['summary']), use_container_width=True, hide_index=True)
+            
+            st.download_button(
+                label="📦 Download All Filled Templates (ZIP)",
+                data=store.get("result/fanout/archive"),
+                file_name=f"fanout_batch_{result['timestamp']}.zip",
+                mime="application/zip",
+                type="primary"
+            )
+    
+    except Exception as e:
+        st.error(f"Error processing data: {str(e)}")
+        st.exception(e)
+
 # Configuration sidebar
 def show_config_sidebar():
     with st.sidebar:
@@ -1041,6 +3108,40 @@ def show_config_sidebar():
         st.write(f"Templates: {len(st.session_state.templates)}")
         st.write(f"User: {st.session_state.get('name', 'Unknown')}")
         st.write(f"Role: {st.session_state.get('user_role', 'Unknown')}")
+        
+        usage = st.session_state.memory_store.usage()
+        st.write(f"Memory: {usage['resident_bytes'] / 1024 / 1024:.1f} / "
+                 f"{usage['budget_bytes'] / 1024 / 1024:.0f} MB "
+                 f"({usage['resident_items']} objects)")
+        st.write(f"Spilled to disk: {usage['spilled_bytes'] / 1024 / 1024:.1f} MB "
+                 f"({usage['spilled_items']} objects, {usage['rehydrations']} reloads)")
+        
+        resources = st.session_state.ai_mapper.resources
+        st.write(f"Shared similarity cache: {len(resources.similarity_cache)} entries "
+                 f"({resources.similarity_cache.hit_rate * 100:.0f}% hits)")
+        
+        # Mapping memory
+        st.subheader("🧠 Mapping Memory")
+        memory = st.session_state.mapping_memory
+        st.write(f"Known matches: {len(memory)}")
+        st.write(f"Hit rate: {memory.hit_rate * 100:.1f}% ({memory.hits}/{memory.hits + memory.misses} lookups)")
+        
+        st.download_button(
+            label="Export Memory",
+            data=memory.export_json(),
+            file_name="mapping_memory.json",
+            mime="application/json"
+        )
+        
+        if st.session_state.get('user_role') == 'admin':
+            memory_file = st.file_uploader("Import Memory", type=['json'], key="memory_import")
+            if memory_file and st.button("Merge Imported Memory"):
+                try:
+                    imported = memory.import_json(memory_file.getvalue().decode('utf-8'))
+                    memory.save()
+                    st.success(f"Imported {imported} matches")
+                except Exception as e:
+                    st.error(f"Failed to import mapping memory: {e}")
 
 # Main application
 def main():
@@ -0,0 +1,31 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+APP_PATH = Path(__file__).resolve().parent.parent / "packaging.py"
+
+# `python -m pytest` puts the repo root on sys.path, where packaging.py would
+# shadow the PyPI 'packaging' that streamlit and others import
+sys.path[:] = [entry for entry in sys.path if Path(entry or ".").resolve() != APP_PATH.parent]
+if getattr(sys.modules.get("packaging"), "__file__", None) == str(APP_PATH):
+    del sys.modules["packaging"]
+
+
+def load_app():
+    """Execute packaging.py as module 'app', like a Streamlit rerun of the script
+
+    The file is loaded by path because 'packaging' would import the PyPI package.
+    Loading it again redefines every class, as each rerun does.
+    """
+    spec = importlib.util.spec_from_file_location("app", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["app"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def app():
+    return load_app()
@@ -0,0 +1,102 @@
+import struct
+import sys
+import types
+
+import pytest
+
+from conftest import load_app
+
+
+def make_fields():
+    return {
+        "A1": {"value": "PACKAGING INSTRUCTION", "row": 1, "column": 1, "merged_range": "A1:D1",
+               "is_label": False, "is_data_cell": False, "cell_type": "title", "section": None},
+        "A3": {"value": "Vendor Name", "row": 3, "column": 1, "merged_range": None,
+               "is_label": True, "is_data_cell": False, "cell_type": "field_header", "section": None},
+        "A8": {"value": "L-mm", "row": 8, "column": 1, "merged_range": None,
+               "is_label": True, "is_data_cell": False, "cell_type": "field_header", "section": "primary_packaging"},
+        "B8": {"value": "W-mm", "row": 8, "column": 2, "merged_range": None,
+               "is_label": True, "is_data_cell": False, "cell_type": "field_header", "section": "primary_packaging"},
+        "AB70000": {"value": "Größe ✓", "row": 70000, "column": 28, "merged_range": "AB70000:AC70001",
+                    "is_label": False, "is_data_cell": True, "cell_type": "data_cell", "section": "secondary"},
+    }
+
+
+def test_round_trip_matches_source_fields(app):
+    fields = make_fields()
+    store = app.TemplateFieldStore.from_fields(fields)
+
+    restored = app.TemplateFieldStore.from_bytes(store.to_bytes())
+
+    assert restored.to_dict() == fields
+    assert restored["B8"]["section"] == "primary_packaging"
+
+
+def test_empty_store_round_trip(app):
+    store = app.TemplateFieldStore.from_fields({})
+
+    assert app.TemplateFieldStore.from_bytes(store.to_bytes()).to_dict() == {}
+
+
+def test_header_is_little_endian(app):
+    data = app.TemplateFieldStore.from_fields(make_fields()).to_bytes()
+
+    assert data[:4] == app.TemplateFieldStore.MAGIC
+    assert struct.unpack_from("<I", data, 4)[0] == 5
+    # Rows are the first array, right after the item sizes
+    offset = 8 + len(app.TemplateFieldStore.TYPECODES)
+    assert struct.unpack_from("<5I", data, offset) == (1, 3, 8, 8, 70000)
+
+
+def test_big_endian_host_writes_same_bytes(app, monkeypatch):
+    store = app.TemplateFieldStore.from_fields(make_fields())
+    little_endian = store.to_bytes()
+
+    monkeypatch.setattr(app, "sys", types.SimpleNamespace(byteorder="big"))
+    # Arrays on a big-endian host hold their items byte-reversed relative to this one
+    swapped = app.TemplateFieldStore.from_bytes(little_endian)
+    assert list(swapped.rows) != list(store.rows)
+    assert swapped.to_bytes() == little_endian
+
+
+def test_item_size_mismatch_is_rejected(app):
+    data = bytearray(app.TemplateFieldStore.from_fields(make_fields()).to_bytes())
+    data[8] = 8  # rows written with 8-byte items
+
+    with pytest.raises(ValueError, match="8-byte"):
+        app.TemplateFieldStore.from_bytes(bytes(data))
+
+
+def test_bad_magic_is_rejected(app):
+    with pytest.raises(ValueError):
+        app.TemplateFieldStore.from_bytes(b"XXXX" + b"\0" * 20)
+
+
+def test_spill_and_rehydrate(app, tmp_path):
+    fields = make_fields()
+    memory_store = app.SessionMemoryStore(1, spill_dir=str(tmp_path))
+    memory_store.put("template/T1/fields", app.TemplateFieldStore.from_fields(fields))
+    memory_store.put("template/T1/file_data", b"x" * 64)
+
+    assert memory_store._spilled["template/T1/fields"][2] == "TemplateFieldStore"
+    restored = memory_store.get("template/T1/fields")
+    assert isinstance(restored, app.TemplateFieldStore)
+    assert restored.to_dict() == fields
+    assert memory_store.rehydrations == 1
+
+
+def test_spill_after_class_redefinition(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "app", sys.modules.get("app"))
+    first_run = load_app()
+    fields = make_fields()
+    memory_store = first_run.SessionMemoryStore(1, spill_dir=str(tmp_path))
+    field_store = first_run.TemplateFieldStore.from_fields(fields)
+
+    second_run = load_app()
+    assert second_run.TemplateFieldStore is not first_run.TemplateFieldStore
+    memory_store.put("template/T1/fields", field_store)
+    memory_store.put("template/T1/file_data", b"x" * 64)
+
+    assert "template/T1/fields" in memory_store._spilled
+    assert not memory_store._unspillable
+    assert memory_store.get("template/T1/fields").to_dict() == fields